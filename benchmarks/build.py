@@ -0,0 +1,257 @@
+"""Build benchmarks on a generated site.
+
+    python benchmarks/build.py --pages 500 --output before.json
+    python benchmarks/build.py --pages 500 --output after.json --compare before.json
+
+Generates a site with `--pages` pages, each extending a chain of `--depth`
+layouts, including `--fanout` partials and linking `--assets` scripts and
+stylesheets, then times:
+
+  cold        full development build into an empty directory
+  noop        incremental development build with nothing changed
+  leaf_edit   one page edited, rebuilt through the watch handler
+  base_edit   the root layout edited, rebuilt through the watch handler
+  prod_cold   full production build into an empty directory
+  prod_noop   incremental production build with nothing changed
+
+The minifiers and pre-compilers are replaced with `cat`, so the numbers are
+jinja-static's own overhead. Results carry the commit they were taken at.
+"""
+import os
+import sys
+import collections
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import jinjastatic
+from jinjastatic import staticlib
+from jinjastatic.dependencies import Dependencies
+
+STUB = '#!/bin/sh\n# Stand-in minifier: prints the file named by its last argument.\nfor last; do :; done\ncat "$last"\n'
+
+
+def generate_site(root, pages, depth, fanout, assets):
+    src = os.path.join(root, 'src')
+    for dirname in ('layouts', 'partials', 'pages', 'js', 'css'):
+        os.makedirs(os.path.join(src, dirname))
+
+    def write(name, data):
+        with open(os.path.join(src, name), 'w') as f:
+            f.write(data)
+
+    write('layouts/base0.html',
+          '<html><head>{% style href="/css/site.css" head=True %}'
+          '{% script src="/js/site.js" head=True %}<title>{% block title %}{% endblock %}</title></head>\n'
+          '<body>{% block body %}{% endblock %}{% script src="/js/footer.js" %}</body></html>\n')
+    for level in range(1, depth):
+        write('layouts/base{0}.html'.format(level),
+              '{{% extends "layouts/base{0}.html" %}}{{% block body %}}<div class="level{1}">'
+              '{{{{ super() }}}}{{% block content{1} %}}{{% endblock %}}</div>{{% endblock %}}\n'.format(level - 1, level))
+    layout = 'layouts/base{0}.html'.format(depth - 1)
+
+    partials = max(fanout * 2, 1)
+    for index in range(partials):
+        write('partials/inc{0}.html'.format(index),
+              '<ul>{% for i in range(20) %}<li>item {{ i }} of partial ' + str(index) + '</li>{% endfor %}</ul>'
+              '{% script src="/js/partial' + str(index) + '.js" %}\n')
+        write('js/partial{0}.js'.format(index), 'var partial{0} = {0};\n'.format(index))
+    write('css/site.css', 'body { color: black; }\n')
+    write('js/site.js', 'var site = 1;\n')
+    write('js/footer.js', 'var footer = 1;\n')
+    for index in range(max(assets, 1) * 4):
+        write('js/lib{0}.js'.format(index), 'var lib{0} = {0};\n'.format(index))
+        write('css/lib{0}.css'.format(index), '.lib{0} {{ width: {0}px; }}\n'.format(index))
+
+    for index in range(pages):
+        includes = ''.join('{{% include "partials/inc{0}.html" %}}'.format((index + k) % partials)
+                           for k in range(fanout))
+        tags = ''.join('{{% script src="/js/lib{0}.js" %}}{{% style href="/css/lib{0}.css" head=True %}}'.format(
+                (index + k) % (max(assets, 1) * 4)) for k in range(assets))
+        write('pages/page{0}.html'.format(index),
+              '{{% extends "{0}" %}}{{% block title %}}Page {1}{{% endblock %}}'
+              '{{% block body %}}{{{{ super() }}}}<h1>Page {1}</h1>{2}{3}'
+              '<p>{{{{ "generated" | upper }}}}</p>{{% endblock %}}\n'.format(layout, index, includes, tags))
+    return src
+
+
+def install_stubs(root):
+    bindir = os.path.join(root, 'bin')
+    os.makedirs(bindir)
+    for name in ('uglifycss', 'lessc'):
+        _write_script(os.path.join(bindir, name), STUB)
+    # The default YUI command is run from the working directory.
+    _write_script(os.path.join(root, 'runyui.sh'), STUB)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+
+
+def _write_script(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+    os.chmod(path, 0755)
+
+
+def build(src, dest, incremental, debug):
+    config = {'plugins': []}
+    jinjastatic.global_config[0] = config
+    compiledir = None
+    if not debug:
+        compiledir = os.path.join(dest, 'compiled')
+        if not os.path.exists(compiledir):
+            os.makedirs(compiledir)
+    snapshot = jinjastatic.Snapshot(src)
+    dependencies = load_dependencies(src, dest, config, snapshot)
+    jinjastatic.compile_jinja(src, dest, config, incremental, debug, compiledir, dependencies,
+                              snapshot=snapshot)
+    return dependencies
+
+
+def load_dependencies(src, dest, config, snapshot=None):
+    env, loader = jinjastatic.get_jinja_env(
+        config, src, os.path.join(jinjastatic.utils.get_cache_dir(dest), 'bytecode'))
+    dependencies = Dependencies(
+        src, env, loader, os.path.join(jinjastatic.utils.get_cache_dir(dest), 'dependencies.json'))
+    dependencies.load_graph(snapshot)
+    return dependencies
+
+
+def check_output(dest):
+    """Fail if a production build left a bundle marker or unpatched page behind."""
+    marker = staticlib.MARKER_PREFIX.encode('utf8')
+    for dirpath, dirnames, filenames in os.walk(dest):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.unpatched'):
+                raise AssertionError('Unpatched page left in {0}'.format(path))
+            if filename.endswith('.html'):
+                with open(path, 'rb') as f:
+                    if marker in f.read():
+                        raise AssertionError('Bundle marker left in {0}'.format(path))
+
+
+def edit(src, name):
+    path = os.path.join(src, name)
+    with open(path, 'a') as f:
+        f.write('<!-- edit {0} -->\n'.format(time.time()))
+
+
+def timeit(func, setup=None, repeat=3):
+    runs = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.time()
+        func(state)
+        runs.append(time.time() - start)
+    runs.sort()
+    return {'min': runs[0], 'median': runs[len(runs) // 2], 'runs': runs}
+
+
+def run_benchmarks(root, args):
+    src = generate_site(root, args.pages, args.depth, args.fanout, args.assets)
+    install_stubs(root)
+    os.chdir(root)
+    dest = os.path.join(root, 'out')
+    prod = os.path.join(root, 'prod')
+
+    def clean(path):
+        def setup():
+            shutil.rmtree(path, ignore_errors=True)
+        return setup
+
+    def handler():
+        # The watch handler is timed on its own; the graph load it relies
+        # on happens once at startup.
+        build(src, dest, True, True)
+        config = jinjastatic.global_config[0]
+        return jinjastatic.FileHandler(src, dest, config, load_dependencies(src, dest, config))
+
+    def edit_and_handle(name):
+        def run(handle):
+            edit(src, name)
+            handle([name])
+        return run
+
+    results = collections.OrderedDict()
+    results['cold'] = timeit(lambda state: build(src, dest, True, True), clean(dest), args.repeat)
+    results['noop'] = timeit(lambda state: build(src, dest, True, True), None, args.repeat)
+    results['leaf_edit'] = timeit(edit_and_handle('pages/page0.html'), handler, args.repeat)
+    results['base_edit'] = timeit(edit_and_handle('layouts/base0.html'), handler, args.repeat)
+    results['prod_cold'] = timeit(lambda state: build(src, prod, False, False), clean(prod), args.repeat)
+    # Pages pick up bundles from the partials they include.
+    check_output(prod)
+    results['prod_noop'] = timeit(lambda state: build(src, prod, True, False), None, args.repeat)
+    check_output(prod)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    if baseline['params'] != results['params']:
+        print 'Warning: baseline was taken with {0}'.format(baseline['params'])
+    print '{0:<12} {1:>10} {2:>10} {3:>8}'.format('benchmark', 'before', 'after', 'ratio')
+    for name, value in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median']
+        print '{0:<12} {1:>9.3f}s {2:>9.3f}s {3:>7.2f}x'.format(
+            name, before, value['median'], value['median'] / before if before else 0)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark jinja-static builds on a generated site.")
+    p.add_argument('--pages', type=int, default=200)
+    p.add_argument('--depth', type=int, default=3, help="Layouts in each page's inheritance chain.")
+    p.add_argument('--fanout', type=int, default=4, help="Partials included by each page.")
+    p.add_argument('--assets', type=int, default=3, help="Script and style tags on each page.")
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--stream', action='store_true', default=False, help="Build with --stream.")
+    p.add_argument('--output', help="Write the results as JSON to this file.")
+    p.add_argument('--compare', help="Print the change against an earlier results file.")
+    p.add_argument('--keep', action='store_true', default=False, help="Keep the generated site.")
+    args = p.parse_args()
+
+    logging.getLogger('jinjastatic').setLevel(logging.ERROR)
+    jinjastatic.stream_output[0] = args.stream
+    root = tempfile.mkdtemp(prefix='jinjastatic-bench')
+    cwd = os.getcwd()
+    try:
+        timings = run_benchmarks(root, args)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print 'Site kept in {0}'.format(root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': dict((key, getattr(args, key)) for key in ('pages', 'depth', 'fanout', 'assets', 'stream')),
+        'results': timings,
+        }
+    for name, value in timings.items():
+        print '{0:<12} median {1:8.3f}s  min {2:8.3f}s'.format(name, value['median'], value['min'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
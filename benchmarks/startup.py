@@ -0,0 +1,102 @@
+"""Startup benchmarks: how long the CLI takes before it does any work.
+
+    python benchmarks/startup.py --output before.json
+    python benchmarks/startup.py --output after.json --compare before.json
+
+Each command runs in a fresh interpreter, `--repeat` times:
+
+  import      python -c "import jinjastatic"
+  help        jinja-static --help
+  noop        incremental development build of a small site with nothing changed
+
+Results carry the commit they were taken at, like benchmarks/build.py.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import collections
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from build import git_commit, compare
+
+RUN = "import sys; sys.argv[0] = 'jinja-static'; import jinjastatic; jinjastatic.run()"
+
+
+def generate_site(root):
+    src = os.path.join(root, 'src')
+    os.makedirs(src)
+    with open(os.path.join(src, 'base.html'), 'w') as f:
+        f.write('<html><body>{% block body %}{% endblock %}</body></html>\n')
+    for index in range(10):
+        with open(os.path.join(src, 'page{0}.html'.format(index)), 'w') as f:
+            f.write('{{% extends "base.html" %}}{{% block body %}}Page {0}{{% endblock %}}\n'.format(index))
+    return src
+
+
+def call(command, cwd):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, cwd=cwd, env=dict(os.environ, PYTHONPATH=ROOT),
+                              stdout=devnull, stderr=devnull)
+
+
+def timeit(command, cwd, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.time()
+        call(command, cwd)
+        runs.append(time.time() - start)
+    runs.sort()
+    return {'min': runs[0], 'median': runs[len(runs) // 2], 'runs': runs}
+
+
+def run_benchmarks(root, args):
+    src = generate_site(root)
+    dest = os.path.join(root, 'out')
+    build = [sys.executable, '-c', RUN, '-s', src, '-d', dest]
+    call(build, root)
+
+    results = collections.OrderedDict()
+    results['import'] = timeit([sys.executable, '-c', 'import jinjastatic'], root, args.repeat)
+    results['help'] = timeit([sys.executable, '-c', RUN, '--help'], root, args.repeat)
+    results['noop'] = timeit(build, root, args.repeat)
+    return results
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark jinja-static's startup time.")
+    p.add_argument('--repeat', type=int, default=10)
+    p.add_argument('--output', help="Write the results as JSON to this file.")
+    p.add_argument('--compare', help="Print the change against an earlier results file.")
+    args = p.parse_args()
+
+    root = tempfile.mkdtemp(prefix='jinjastatic-bench')
+    try:
+        timings = run_benchmarks(root, args)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {'repeat': args.repeat},
+        'results': timings,
+        }
+    for name, value in timings.items():
+        print '{0:<12} median {1:8.3f}s  min {2:8.3f}s'.format(name, value['median'], value['min'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,31 +2,93 @@ import os
 import sys
 import argparse
 import logging
-import shutil
 import importlib
-
-import yaml
-import jinja2
-import logging
-import jinjatag
+import itertools
+import threading
+import multiprocessing
 import datetime
 
 
-from utils import is_updated
-import staticlib
-from watcher import setup_watch
-from dependencies import Dependencies
+# jinja2, yaml, watchdog and the notification backends are imported where
+# they are first needed, so `--help`, the client and builds that never
+# watch or minify don't pay for them.
+import utils
+from utils import is_updated, mark_updated, replace_file, replace_file_chunks, replace_file_with, link_or_copy
+from timings import profiler, timed
+from snapshot import Snapshot
 
 logger = logging.getLogger('jinjastatic')
 
 global_config = [None]
 
+stream_output = [False]
+
+STREAM_BATCH = 4096
+
 sys.path.insert(0, os.getcwd())
 
 def run():
+    if len(sys.argv) > 1 and sys.argv[1] in ('daemon', 'client'):
+        import daemon
+        return getattr(daemon, 'run_' + sys.argv[1])(sys.argv[2:])
+
     configure_logging()
 
-    p = argparse.ArgumentParser(description="Compile static templates")
+    p = get_parser()
+    args = p.parse_args()
+    if args.serve and args.production:
+        p.error("argument -p/--production: not allowed with --serve, which never minifies")
+    # --serve renders from memory, so it only needs -d for its caches.
+    if not args.dest and not args.serve:
+        p.error("argument -d/--dest is required unless --serve is given")
+    config, compiledir = configure(args)
+
+    from dependencies import Dependencies
+
+    cache_dir = utils.get_cache_dir(args.dest) if args.dest else None
+    env, loader = get_jinja_env(config, args.source,
+                                cache_dir and os.path.join(cache_dir, 'bytecode'))
+    dependencies = Dependencies(args.source, env, loader,
+                                cache_dir and os.path.join(cache_dir, 'dependencies.json'))
+    with timed('phase', 'scan'):
+        snapshot = Snapshot(args.source)
+    with timed('phase', 'load_graph'):
+        dependencies.load_graph(snapshot)
+
+    if args.serve:
+        import staticlib
+        from server import DevServer, serve
+        from watcher import setup_watch
+        staticlib.clear_data()
+        staticlib.set_config(True, config, args.source)
+        def render(name):
+            data = render_file(env, name)
+            record_edges(dependencies, [name])
+            return data
+        site = DevServer(args.source, dependencies, render)
+        serve(site, port=args.port)
+        setup_watch(args.source, site, ['.*', '*#*', '*~'])
+        return
+
+    if args.watch:
+        from watcher import setup_watch
+        compile_jinja(args.source, args.dest, config, True, True, compiledir, dependencies,
+                      args.jobs, args.compile_jobs, snapshot)
+        write_profile(args.profile, args.profile_top)
+        handler = FileHandler(args.source, args.dest, config, dependencies, args.lazy)
+        setup_watch(args.source,
+                    handler,
+                    ['.*', '*#*', '*~'],
+                    on_interrupt=handler.cancel)
+        return
+
+    compile_jinja(args.source, args.dest, config, not args.full, not args.production, compiledir, dependencies,
+                  args.jobs, args.compile_jobs, snapshot)
+    write_profile(args.profile, args.profile_top)
+
+
+def get_parser(description="Compile static templates"):
+    p = argparse.ArgumentParser(description=description)
     p.add_argument('-s', '--source', required=True,
                    help="Source file or directory.")
     p.add_argument('-d', '--dest',
@@ -47,8 +109,26 @@ def run():
                    help='Verbose output')
     p.add_argument('-j', '--plugins', default=None,
                    help="Template Plugins")
-    args = p.parse_args()
-
+    p.add_argument('-J', '--jobs', type=int, default=1,
+                   help="Number of processes to render templates with.")
+    p.add_argument('--lazy', action='store_true', default=False,
+                   help="In watch mode, render pages affected by a change in the background, edited pages first. "
+                   "CTRL-C cancels the pages still waiting.")
+    p.add_argument('--serve', action='store_true', default=False,
+                   help="Serve the site from memory with live reload while watching.")
+    p.add_argument('--port', type=int, default=8000,
+                   help="Port for --serve.")
+    p.add_argument('--compile-jobs', type=int, default=multiprocessing.cpu_count(),
+                   help="Number of minifier processes to run at once.")
+    p.add_argument('--stream', action='store_true', default=False,
+                   help="Write pages to disk as they render instead of rendering each one in memory first.")
+    p.add_argument('--profile', metavar='FILE', nargs='?', const='jinjastatic-profile.json',
+                   help="Time the build and write a Chrome trace to FILE.")
+    p.add_argument('--profile-top', type=int, default=10,
+                   help="Number of slowest items per category to print with --profile.")
+    return p
+
+def configure(args):
     if args.quiet:
         logger.setLevel(logging.ERROR)
     elif args.verbose:
@@ -68,147 +148,419 @@ def run():
 
     config = {}
     if os.path.exists(args.config):
+        import yaml
         with open(args.config) as f:
             config = yaml.load(f.read())
 
+    if args.profile:
+        profiler.enable()
+
+    stream_output[0] = args.stream
+
     if args.plugins:
-        config['plugins'] = args.split(',')
+        config['plugins'] = args.plugins.split(',')
 
     config.setdefault("plugins", [])
 
     global_config[0] = config
+    return config, compiledir
 
-    env, loader = get_jinja_env(config, args.source)
-    dependencies = Dependencies(args.source, env, loader)
-    dependencies.load_graph()
 
-    if args.watch:
-        compile_jinja(args.source, args.dest, config, True, True, compiledir, dependencies)
-        setup_watch(args.source,
-                    FileHandler(args.source, args.dest, config, dependencies),
-                    ['.*', '*#*', '*~'],
-                    )
+def write_profile(filename, top):
+    if not profiler.enabled:
         return
+    profiler.report(top)
+    profiler.write_trace(filename)
+    logger.info("Wrote profile to {0}".format(filename))
 
-    compile_jinja(args.source, args.dest, config, not args.full and not args.production, not args.production, compiledir, dependencies)
 
+def compile_jinja(source, dest, config, incremental, debug, compiledir, dependencies,
+                  jobs=1, compile_jobs=1, snapshot=None):
+    import staticlib
+    env = dependencies.env
 
-def compile_jinja(source, dest, config, incremental, debug, compiledir, dependencies):
-    env = get_jinja_env(config, source)[0]
+    manifest = utils.load_manifest(dest, config, debug)
+    with timed('phase', 'scan'):
+        if snapshot is None:
+            snapshot = Snapshot(source)
+        manifest.snapshots = [snapshot, Snapshot(dest, exclude=[utils.CACHE_DIR])]
 
     staticlib.clear_data()
 
-    staticlib.set_config(debug, config, source)
+    staticlib.set_config(debug, config, source, compile_jobs)
 
     if incremental:
-        changed = walk_for_changed(source, dest, dependencies)
+        with timed('phase', 'walk_for_changed'):
+            changed = walk_for_changed(source, dest, dependencies, snapshot)
     else:
         changed = ()
 
+    bundles_file = os.path.join(utils.get_cache_dir(dest), 'bundles.json')
     if not debug:
-        walk_and_compile(env, source, dest, incremental, False, changed)
-        staticlib.compile(source, compiledir, dest)
-    walk_and_compile(env, source, dest, incremental, True, changed)
-
-def walk_and_compile(env, source, dest, incremental, save, changed):
-    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
-        reldir = dirpath[len(source):].lstrip('/')
+        staticlib.start_precompiles()
+        if incremental:
+            for new_file, (old_file, mime) in staticlib.load_bundles(bundles_file, source).items():
+                staticlib.queue_precompile(old_file, new_file, mime)
+            changed = changed | staticlib.forget_pages(changed)
+    with timed('phase', 'walk_and_compile'):
+        rendered = walk_and_compile(env, source, dest, incremental, changed, jobs, snapshot)
+    if not debug:
+        with timed('phase', 'finish_precompiles'):
+            staticlib.finish_precompiles()
+            copy_precompiled(source, dest, incremental)
+        with timed('phase', 'minify'):
+            staticlib.compile(source, compiledir, dest)
+        with timed('phase', 'patch_pages'):
+            patch_pages(env, source, dest, rendered)
+        staticlib.save_bundles(bundles_file)
+    if incremental:
+        with timed('phase', 'remove_orphans'):
+            remove_orphans(manifest)
+    dependencies.removed = set()
+    with timed('phase', 'save'):
+        record_edges(dependencies, rendered)
+        dependencies.save()
+        manifest.save()
+    # Later watch-mode rebuilds stat the files themselves.
+    manifest.snapshots = []
+
+def walk_and_compile(env, source, dest, incremental, changed, jobs=1, snapshot=None):
+    import staticlib
+    if snapshot is None:
+        snapshot = Snapshot(source)
+    pending = []
+    for name, st in snapshot:
+        fullsource = os.path.join(source, name)
+        fulldest = os.path.join(dest, name)
+        if not name.lower().endswith('.html'):
+            if not staticlib.handle_precompile_file(fullsource, fulldest, incremental=incremental):
+                copy_file(fullsource, fulldest, incremental)
+            continue
+        if not incremental or name in changed:
+            pending.append((name, fullsource, fulldest))
+
+    if jobs > 1 and len(pending) > 1:
+        compile_parallel(env, source, pending, jobs)
+    else:
+        for source_name, source_file, target_file in pending:
+            _compile_pending(env, source_name, source_file, target_file)
+    return [source_name for source_name, source_file, target_file in pending]
+
+def compile_parallel(env, source, pending, jobs):
+    import staticlib
+    bytecode_dir = getattr(env.bytecode_cache, 'directory', None)
+    pool = multiprocessing.Pool(jobs, _init_worker,
+                                (global_config[0], source, bytecode_dir,
+                                 staticlib.get_state(), utils.manifest[0], profiler.enabled,
+                                 stream_output[0]))
+    try:
+        # imap hands results back in submission order, so the asset
+        # registrations are merged exactly as a serial walk would add them.
+        chunksize = max(1, len(pending) // (jobs * 4))
+        for assets, precompiles, records, events in pool.imap(_compile_worker, pending, chunksize):
+            staticlib.merge_assets(assets)
+            profiler.merge(events)
+            for new_file, (old_file, mime) in precompiles.items():
+                staticlib.queue_precompile(old_file, new_file, mime)
+            if records:
+                utils.manifest[0].merge(records)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+_worker_env = [None]
+
+def _init_worker(config, source, bytecode_dir, state, manifest, profile, stream):
+    import staticlib
+    global_config[0] = config
+    stream_output[0] = stream
+    if profile:
+        profiler.enable()
+    staticlib.set_state(state)
+    utils.manifest[0] = manifest
+    if manifest is not None:
+        # Only what this worker records and hashes goes back to the parent.
+        manifest.drain()
+    _worker_env[0] = get_jinja_env(config, source, bytecode_dir)[0]
+
+def _compile_worker(args):
+    import staticlib
+    _compile_pending(_worker_env[0], *args)
+    manifest = utils.manifest[0]
+    return (staticlib.pop_assets(),
+            staticlib.pop_precompiles(),
+            manifest.drain() if manifest is not None else None,
+            profiler.drain())
+
+def _compile_pending(env, source_name, source_file, target_file):
+    try:
+        compile_file(env, source_name, source_file, target_file, False)
+    except Exception as e:
+        logger.error("   In file {0}: {1}".format(source_name, str(e)), exc_info=True)
+
+def patch_pages(env, source, dest, rendered):
+    import staticlib
+    rendered = set(rendered)
+    # Rendered pages without markers are visited too, so no unpatched
+    # file is left behind in dest.
+    for source_name in set(staticlib.g['markers']) | rendered:
+        dest_file = os.path.join(dest, source_name)
+        if source_name not in rendered:
+            # Pages kept from an earlier build only need rendering again
+            # when one of their bundles was renamed.
+            if os.path.exists(dest_file) and staticlib.links_changed(source_name):
+                logger.debug("Re-rendering {0} for its new bundles".format(source_name))
+                staticlib.g['minified'].pop(source_name, None)
+                _compile_pending(env, source_name, os.path.join(source, source_name), dest_file)
+            continue
+        unpatched = _unpatched_file(dest_file)
+        if not os.path.exists(unpatched):
+            continue
+        with open(unpatched, 'rb') as f:
+            patched = _write_patched(source_name, f, dest_file)
+        os.unlink(unpatched)
+        if not patched:
+            logger.debug("Re-rendering {0} to fill in its bundles".format(source_name))
+            _compile_pending(env, source_name, os.path.join(source, source_name), dest_file)
+
+def remove_unpatched(dest):
+    """Delete the renders a failed build left for patch_pages."""
+    for dirpath, dirnames, filenames in os.walk(dest):
         for filename in filenames:
-            fullsource = os.path.join(source, reldir, filename)
-            fulldest = os.path.join(dest, reldir, filename)
-            if not filename.lower().endswith('.html'):
-                if save and not staticlib.handle_precompile_file(fullsource, fulldest, incremental=incremental):
-                    copy_file(fullsource, fulldest, incremental)
-                continue
-            if save:
-                target_file = os.path.join(dest, reldir, filename)
-            else:
-                target_file = None
-            try:
-                if not incremental or os.path.join(reldir, filename) in changed:
-                    compile_file(env, os.path.join(reldir, filename),
-                                 os.path.join(dirpath, filename), target_file, False)
-            except Exception as e:
-                logger.error("   In file {0}: {1}".format(os.path.join(reldir, filename),
-                                                        str(e)), exc_info=True)
-
-def walk_for_changed(source, dest, dependencies):
+            if filename.startswith('.') and filename.endswith('.unpatched'):
+                os.unlink(os.path.join(dirpath, filename))
+
+def _write_patched(source_name, f, dest_file):
+    import staticlib
+    if not stream_output[0]:
+        data = staticlib.patch_markers(source_name, f.read())
+        if data is not None:
+            replace_file(dest_file, data)
+        return data is not None
+    try:
+        replace_file_chunks(dest_file, staticlib.patch_marker_lines(source_name, f))
+    except staticlib.MissingMarker:
+        return False
+    return True
+
+def walk_for_changed(source, dest, dependencies, snapshot=None):
+    if snapshot is None:
+        snapshot = Snapshot(source)
     changed = set()
-    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
-        reldir = dirpath[len(source):].lstrip('/')
-        for filename in filenames:
-            if not filename.lower().endswith('.html'):
-                continue
-            name = os.path.join(reldir, filename)
-            if is_updated(os.path.join(source, reldir, filename),
-                          os.path.join(dest, reldir, filename)):
-                changed.add(name)
-                changed.update(dependencies.get_affected_files(name))
+    for name, st in snapshot:
+        if name.lower().endswith('.html'):
+            signed = True
+        elif dependencies.has_dependents(name):
+            signed = False
+        else:
+            continue
+        if is_updated(os.path.join(source, name), os.path.join(dest, name), signed=signed):
+            changed.add(name)
+    changed.update(dependencies.get_stale_data_users())
+    changed.update(dependencies.removed)
+    changed.update(dependencies.get_affected(changed))
     return changed
 
+def remove_orphans(manifest):
+    """Delete the outputs whose source was removed since they were built."""
+    orphans = manifest.orphans()
+    # Removing a pre-compiled file can orphan the copy made of it.
+    while orphans:
+        for dest_file in orphans:
+            remove_output(manifest, dest_file)
+        orphans = manifest.orphans()
+
+def remove_output(manifest, dest_file):
+    if os.path.exists(dest_file):
+        logger.info("Removing {0}".format(dest_file))
+        os.unlink(dest_file)
+    manifest.remove(dest_file)
+
+def record_edges(dependencies, pages):
+    import staticlib
+    dependencies.record_edges(pages, staticlib.pop_edges())
+
 
 class FileHandler(object):
-    def __init__(self, source, dest, config, dependencies):
+    def __init__(self, source, dest, config, dependencies, lazy=False):
         self.source = source
         self.dest = dest
         self.config = config
         self.dependencies = dependencies
-
-    def __call__(self, files):
-        env = get_jinja_env(self.config, self.source)[0]
-        for fname in files:
-            self.dependencies.recompute_file(fname)
-        total_changed = set()
-        for fname in files:
-            total_changed.add(fname)
-            total_changed.update(self.dependencies.get_affected_files(fname))
-        for fname in total_changed:
-            fullsource = os.path.join(self.source, fname)
-            fulldest = os.path.join(self.dest, fname)
-            if fname.lower().endswith('.html'):
-                compile_file(env, fname, fullsource,
-                             fulldest, False)
-            elif staticlib.handle_precompile_file(fullsource, fulldest):
-                continue
+        self.lock = threading.RLock()
+        if lazy:
+            from renderqueue import RenderQueue
+            self.queue = RenderQueue(self.render, self.save)
+        else:
+            self.queue = None
+
+    def __call__(self, files, deleted=()):
+        import staticlib
+        with self.lock:
+            for fname in deleted:
+                self.remove(fname)
+            for fname in files:
+                self.dependencies.recompute_file(fname)
+            total_changed = set(files)
+            total_changed.update(self.dependencies.get_affected(list(files) + list(deleted)))
+            total_changed.difference_update(deleted)
+            pages = []
+            for fname in total_changed:
+                fullsource = os.path.join(self.source, fname)
+                fulldest = os.path.join(self.dest, fname)
+                if fname.lower().endswith('.html'):
+                    pages.append(fname)
+                elif staticlib.handle_precompile_file(fullsource, fulldest):
+                    continue
+                else:
+                    copy_file(fullsource, fulldest, False)
+            if self.queue is not None:
+                self.queue.mark_stale(pages, edited=[fname for fname in files if fname in pages])
             else:
-                copy_file(fullsource, fulldest, False)
+                for fname in pages:
+                    self.render(fname)
+            self.save()
+
+    def cancel(self):
+        """Stop rendering the pages left from the last change, if there are any."""
+        if self.queue is None:
+            return False
+        cancelled = self.queue.cancel()
+        if not cancelled:
+            return False
+        with self.lock:
+            manifest = utils.manifest[0]
+            if manifest is not None:
+                # So the next incremental build renders them.
+                for fname in cancelled:
+                    manifest.invalidate(os.path.join(self.dest, fname))
+                manifest.save()
+        logger.info("Cancelled rendering of {0} stale page(s); CTRL-C again to stop watching.".format(
+                len(cancelled)))
+        return True
+
+    def remove(self, fname):
+        self.dependencies.remove_file(fname)
+        if self.queue is not None:
+            self.queue.discard(fname)
+        manifest = utils.manifest[0]
+        if manifest is not None:
+            for dest_file in manifest.outputs_of(os.path.join(self.source, fname)):
+                remove_output(manifest, dest_file)
+
+    def render(self, fname):
+        with self.lock:
+            compile_file(self.dependencies.env, fname, os.path.join(self.source, fname),
+                         os.path.join(self.dest, fname), False)
+            record_edges(self.dependencies, [fname])
+
+    def save(self):
+        with self.lock:
+            self.dependencies.save()
+            if utils.manifest[0] is not None:
+                utils.manifest[0].save()
+
+def copy_precompiled(source, dest, incremental):
+    # Pages write their pre-compiled files into the source tree as they
+    # render, after walk_and_compile has copied it, so copy them here too.
+    import staticlib
+    root = os.path.abspath(source)
+    for new_file in staticlib.g['precompiles']:
+        path = os.path.abspath(new_file)
+        if path.startswith(root + os.sep) and os.path.exists(path):
+            copy_file(path, os.path.join(dest, path[len(root) + 1:]), incremental)
 
 def copy_file(source, dest, incremental):
     if not incremental or is_updated(source, dest):
-        if not os.path.exists(os.path.dirname(dest)):
-            os.makedirs(os.path.dirname(dest))
-        logger.debug("Copying file {0} to output directory".format(source))
-        shutil.copyfile(source, dest)
+        if link_or_copy(source, dest):
+            logger.debug("Copied file {0} to output directory".format(source))
+        mark_updated(source, dest)
 
 def compile_file(env, source_name, source_file, dest_file, incremental):
-    if incremental and not is_updated(source_file, dest_file):
+    import staticlib
+    if incremental and not is_updated(source_file, dest_file, signed=True):
         return
 
     if dest_file:
         logger.info("Compiling {0} -> {1}".format(source_file, dest_file))
-    ctx = {
+    if dest_file and stream_output[0]:
+        # Whether the page has bundle markers is only known once it has
+        # been rendered, so it is streamed to its unpatched name first.
+        unpatched = _unpatched_file(dest_file)
+        with timed('template', source_name):
+            if not stream_file(env, source_name, unpatched):
+                return
+        if not staticlib.has_markers(source_name):
+            replace_file_with(dest_file, unpatched)
+        mark_updated(source_file, dest_file, signed=True)
+        return
+    with timed('template', source_name):
+        result = render_file(env, source_name)
+    if result is None or not dest_file:
+        return
+    if staticlib.has_markers(source_name):
+        # Keep the render out of dest until patch_pages has filled in its
+        # bundles, so an unchanged page is never rewritten.
+        replace_file(_unpatched_file(dest_file), result)
+    else:
+        replace_file(dest_file, result)
+    mark_updated(source_file, dest_file, signed=True)
+
+def _unpatched_file(dest_file):
+    dirname, basename = os.path.split(dest_file)
+    return os.path.join(dirname, '.' + basename + '.unpatched')
+
+def render_file(env, source_name):
+    try:
+        template = get_page_template(env, source_name)
+        return template.render(_page_context(source_name)).encode('utf8')
+    except Exception as e:
+        logger.error("Error compiling {0}".format(source_name), exc_info=True)
+
+def stream_file(env, source_name, dest_file):
+    """Render a page into `dest_file` a chunk at a time. Returns whether it rendered."""
+    try:
+        template = get_page_template(env, source_name)
+        items = template.generate(_page_context(source_name))
+        # The template yields many small strings; join them in batches
+        # before encoding and writing.
+        batches = iter(lambda: list(itertools.islice(items, STREAM_BATCH)), [])
+        replace_file_chunks(dest_file, (u''.join(batch).encode('utf8') for batch in batches))
+    except Exception as e:
+        logger.error("Error compiling {0}".format(source_name), exc_info=True)
+        return False
+    return True
+
+def get_page_template(env, source_name):
+    import staticlib
+    staticlib.start_page(source_name)
+    template = env.get_template(source_name)
+    run_plugins(global_config[0]['plugins'], template)
+    return template
+
+def _page_context(source_name):
+    return {
         'datetime': datetime,
         'env': EnvWrapper(),
         'file': source_name,
         }
-    try:
-        template = env.get_template(source_name)
-        run_plugins(global_config[0]['plugins'], template)
-        result = template.render(ctx).encode('utf8')
-    except Exception as e:
-        logger.error("Error compiling {0}".format(source_name), exc_info=True)
-        return
-    if not dest_file:
-        return
-    with with_dir(open, dest_file, 'w+') as f:
-        f.write(result)
 
-def get_jinja_env(config, source):
+def get_jinja_env(config, source, bytecode_dir=None):
+    import jinja2
+    import jinjatag
+    # Registers the asset tags, which jinja_tag.init() picks up.
+    import staticlib
+    from bytecode import BytecodeCache
     jinja_tag = jinjatag.JinjaTag()
     loader = jinja2.FileSystemLoader(source)
     env = jinja2.Environment(loader=loader, extensions=[jinja_tag])
     run_plugins(config['plugins'], env)
     jinja_tag.init()
+    if bytecode_dir:
+        env.bytecode_cache = BytecodeCache(bytecode_dir, env, config['plugins'])
     return env, loader
 
 def run_plugins(plugins, payload):
@@ -220,12 +572,6 @@ def run_plugins(plugins, payload):
             print "Error in {}: {}".format(plugin, e)
 
 
-def with_dir(callback, filename, *args, **kwargs):
-    dirname = os.path.dirname(filename)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    return callback(filename, *args, **kwargs)
-
 def configure_logging():
     logger.setLevel(logging.INFO)
     fh = logging.StreamHandler()
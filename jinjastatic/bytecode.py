@@ -0,0 +1,33 @@
+import os
+import hashlib
+import tempfile
+
+import jinja2
+
+__all__ = [
+    'BytecodeCache',
+]
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode cache whose file names also carry the environment's extension set.
+
+    Jinja already keys buckets on the template name and checksums the
+    source; the extra key keeps code compiled with a different set of tags
+    or plugins from being loaded.
+    """
+    def __init__(self, directory, env, plugins):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        key = hashlib.md5('|'.join([jinja2.__version__] + sorted(env.extensions) +
+                                   list(plugins))).hexdigest()[:10]
+        jinja2.FileSystemBytecodeCache.__init__(self, directory,
+                                                '__jinjastatic_%s_' + key + '.cache')
+
+    def dump_bytecode(self, bucket):
+        # Pool workers may compile the same template at once, so write
+        # beside the target and rename over it.
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.rename(tmp, self._get_cache_filename(bucket))
@@ -0,0 +1,177 @@
+import os
+import sys
+import copy
+import json
+import signal
+import socket
+import logging
+import argparse
+
+import jinjastatic
+import utils
+from snapshot import Snapshot
+from timings import profiler
+from dependencies import Dependencies
+
+__all__ = [
+    'BuildDaemon',
+    'run_daemon',
+    'run_client',
+]
+
+logger = logging.getLogger('jinjastatic')
+
+DEFAULT_SOCKET = '.jinjastatic.sock'
+
+
+class BuildDaemon(object):
+    """Keeps the jinja environment, dependency graph and manifest of one site warm.
+
+    Clients send one JSON line, ``{"paths": [...], "full": false}``, and get
+    the build's log back as ``{"log": ...}`` lines followed by
+    ``{"status": n}``. Without ``paths`` the whole tree is checked for
+    changes; with them only those files are re-parsed for dependencies.
+    Builds run one at a time, in the order clients connect.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.config, self.compiledir = jinjastatic.configure(args)
+        cache_dir = utils.get_cache_dir(args.dest)
+        self.env, loader = jinjastatic.get_jinja_env(
+            copy.deepcopy(self.config), args.source, os.path.join(cache_dir, 'bytecode'))
+        self.dependencies = Dependencies(args.source, self.env, loader,
+                                         os.path.join(cache_dir, 'dependencies.json'))
+        self.dependencies.load_graph()
+
+    def build(self, paths=None, full=False):
+        if self.args.profile:
+            # Start over, so each request writes the profile of its own build.
+            profiler.enable()
+        try:
+            return self._build(paths, full)
+        finally:
+            jinjastatic.write_profile(self.args.profile, self.args.profile_top)
+
+    def _build(self, paths, full):
+        # set_config rewrites config['map'] in place, so every build gets its own.
+        config = copy.deepcopy(self.config)
+        jinjastatic.global_config[0] = config
+        source = self.args.source
+        snapshot = Snapshot(source)
+        if paths is None:
+            self.dependencies.load_graph(snapshot)
+        else:
+            for path in paths:
+                if os.path.exists(os.path.join(source, path)):
+                    self.dependencies.recompute_file(path)
+                else:
+                    self.dependencies.remove_file(path)
+                    # As load_graph does, so the pages that used it are rebuilt.
+                    self.dependencies.removed.add(path)
+        try:
+            jinjastatic.compile_jinja(source, self.args.dest, config, not full, not self.args.production,
+                                      self.compiledir, self.dependencies,
+                                      self.args.jobs, self.args.compile_jobs, snapshot)
+            return 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            logger.error("Build failed", exc_info=True)
+            status = 1
+        # The manifest in memory records pages that were only rendered to
+        # their unpatched files; start over from the one on disk, as a new
+        # process would.
+        utils.manifest[0] = None
+        jinjastatic.remove_unpatched(self.args.dest)
+        return status
+
+    def serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(5)
+        logger.info("Build daemon listening on {0}".format(path))
+        try:
+            while True:
+                conn, address = server.accept()
+                try:
+                    self.handle(conn)
+                except Exception:
+                    logger.error("Error handling a build request", exc_info=True)
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.unlink(path)
+
+    def handle(self, conn):
+        stream = conn.makefile('rwb', 0)
+        request = json.loads(stream.readline() or '{}')
+        handler = ClientHandler(stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        try:
+            status = self.build(request.get('paths'), request.get('full', False))
+        finally:
+            logger.removeHandler(handler)
+        stream.write(json.dumps({'status': status}) + '\n')
+
+
+class ClientHandler(logging.Handler):
+    def __init__(self, stream):
+        logging.Handler.__init__(self)
+        self.stream = stream
+
+    def emit(self, record):
+        self.stream.write(json.dumps({'log': self.format(record), 'level': record.levelname}) + '\n')
+
+    def handleError(self, record):
+        # The client went away; the build carries on regardless.
+        pass
+
+
+def run_daemon(argv):
+    jinjastatic.configure_logging()
+    p = jinjastatic.get_parser("Keep a site's build state in memory and build it on request")
+    p.add_argument('--socket', default=DEFAULT_SOCKET,
+                   help="Unix socket to listen on.")
+    args = p.parse_args(argv)
+    if not args.dest:
+        p.error("argument -d/--dest is required")
+    # Let `kill` unwind through serve() so the socket is removed. It raises
+    # KeyboardInterrupt, which build() does not catch, unlike SystemExit.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        BuildDaemon(args).serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_client(argv):
+    p = argparse.ArgumentParser(description="Ask a running jinja-static daemon for a build")
+    p.add_argument('paths', nargs='*',
+                   help="Changed files, relative to the source directory. By default the whole tree is checked.")
+    p.add_argument('-f', '--full', action='store_true', default=False,
+                   help="Rebuild everything.")
+    p.add_argument('--socket', default=DEFAULT_SOCKET,
+                   help="Unix socket the daemon listens on.")
+    args = p.parse_args(argv)
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(args.socket)
+    except socket.error as e:
+        sys.stderr.write("Could not connect to the daemon on {0}: {1}\n".format(args.socket, e))
+        sys.exit(2)
+    request = {'full': args.full}
+    if args.paths:
+        request['paths'] = args.paths
+    conn.sendall(json.dumps(request) + '\n')
+    for line in conn.makefile('rb'):
+        message = json.loads(line)
+        if 'status' in message:
+            sys.exit(message['status'])
+        sys.stderr.write(message['log'].encode('utf8') + '\n')
+    sys.stderr.write("The daemon closed the connection before the build finished\n")
+    sys.exit(1)
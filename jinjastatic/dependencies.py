@@ -1,54 +1,224 @@
 import os
-import jinja2
-from jinja2 import meta
-import networkx as nx
+import re
+import json
 import logging
+import collections
+
+import utils
+from snapshot import Snapshot
 
 logger = logging.getLogger('jinjastatic')
 
+LESS_IMPORT = re.compile(r'''@import\s*(?:\([^)]*\)\s*)?(?:url\(\s*)?["']([^"']+)["']''')
+
+def find_imports(path):
+    """Return the files a LESS stylesheet pulls in with `@import`."""
+    if not path.endswith('.less') or not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        text = f.read()
+    imports = []
+    for name in LESS_IMPORT.findall(text):
+        if '//' in name or name.endswith('.css'):
+            continue
+        if not os.path.splitext(name)[1]:
+            name += '.less'
+        imports.append(os.path.normpath(os.path.join(os.path.dirname(path), name)))
+    return imports
+
+def find_all_imports(path):
+    seen = []
+    stack = find_imports(path)
+    while stack:
+        imported = stack.pop()
+        if imported not in seen and imported != path:
+            seen.append(imported)
+            stack.extend(find_imports(imported))
+    return sorted(seen)
+
+
 class Dependencies(object):
-    def __init__(self, source, env, loader):
+    """Which pages have to be rebuilt when a source file changes.
+
+    Render dependencies are template includes, LESS imports and data files
+    plugins declared with `staticlib.add_dependency`; `get_affected` follows
+    those. The assets a page links to with the static tags are not tracked:
+    bundles are checked against their files on every production build.
+    """
+    def __init__(self, source, env, loader, cache_file=None):
         self.env = env
         self.loader = loader
         self.source = source
-        self.dependency_graph = nx.DiGraph()
-
-    def get_affected_files(self, template, acc=None):
-        if not acc:
-            acc = set()
-        if template in self.dependency_graph:
-            for child in self.dependency_graph.successors(template):
-                acc.add(child)
-                self.get_affected_files(child, acc)
-        return list(acc)
-
-    def load_graph(self):
-        self.depencency_graph = nx.DiGraph()
-        for relpath, dirnames, filenames in os.walk(self.source):
-            for filename in filenames:
-                if not filename.endswith('.html'):
-                    continue
-                path = os.path.join(relpath, filename)
-                name = path[len(self.source):].lstrip('/')
-                requirements = self._get_requirements(name)
-                for requirement in requirements:
-                    if requirement:
-                        self.dependency_graph.add_edge(requirement, name)
+        self.cache_file = cache_file
+        self.requirements = {}
+        self.declared = {}
+        self.dependents = collections.defaultdict(set)
+        self.closures = {}
+        self.removed = set()
+        self.dirty = False
+
+    def get_affected_files(self, template):
+        return list(self.get_affected([template]))
+
+    def get_affected(self, templates):
+        """Return every template that transitively depends on any of `templates`."""
+        affected = set()
+        pending = []
+        for template in templates:
+            if template in self.closures:
+                affected.update(self.closures[template])
+            else:
+                pending.append(template)
+        if len(pending) == 1:
+            self.closures[pending[0]] = closure = frozenset(self._reachable(pending))
+            affected.update(closure)
+        elif pending:
+            affected.update(self._reachable(pending))
+        return affected
+
+    def get_stale_data_users(self):
+        """Return the pages whose declared data files changed since they were rendered."""
+        stale = set()
+        digests = {}
+        for page, declared in self.declared.items():
+            for name, digest in declared.items():
+                if name not in digests:
+                    digests[name] = self._digest(name)
+                if digests[name] != digest:
+                    stale.add(page)
+                    break
+        return stale
+
+    def has_dependents(self, name):
+        return bool(self.dependents.get(name))
+
+    def record_edges(self, pages, data_edges):
+        """Replace the data edges of freshly rendered `pages`."""
+        for page in pages:
+            self.closures = {}
+            old = self.declared.pop(page, {})
+            self._unlink(page, old)
+            paths = set(self._name(path) for path in data_edges.get(page, ()))
+            if paths:
+                self.declared[page] = dict((name, self._digest(name)) for name in paths)
+                self._link(page, paths)
+            if old != self.declared.get(page, {}):
+                self.dirty = True
+
+    def _name(self, path):
+        path = os.path.abspath(path)
+        source = os.path.abspath(self.source) + os.sep
+        if path.startswith(source):
+            return path[len(source):]
+        return path
+
+    def _digest(self, name):
+        path = os.path.join(self.source, name)
+        if not os.path.isfile(path):
+            return None
+        return utils.file_digest(path)
+
+    def _reachable(self, templates):
+        seen = set()
+        stack = list(templates)
+        while stack:
+            for child in self.dependents.get(stack.pop(), ()):
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    def load_graph(self, snapshot=None):
+        if snapshot is None:
+            snapshot = Snapshot(self.source)
+        self.dependents = collections.defaultdict(set)
+        self.closures = {}
+        data = self._load_cache()
+        cached = data.get('requirements', {})
+        self.requirements = {}
+        parsed = 0
+        for name, st in snapshot:
+            if not name.endswith(('.html', '.less')):
+                continue
+            entry = cached.get(name)
+            if not entry or entry[0] != st.st_size or entry[1] != st.st_mtime:
+                entry = [st.st_size, st.st_mtime, self._get_requirements(name)]
+                parsed += 1
+            self.requirements[name] = entry
+            self._link(name, entry[2])
+        self.declared = dict((page, declared) for page, declared in data.get('declared', {}).items()
+                             if page in self.requirements)
+        for page, declared in self.declared.items():
+            self._link(page, declared)
+        # Files deleted since the last build still have dependents to rebuild.
+        self.removed = set(cached) - set(self.requirements)
+        logger.debug("Parsed {0} of {1} templates for dependencies".format(parsed, len(self.requirements)))
+        # Saved once the build is done: the cache still lists the removed
+        # files until then, so a build that fails finds them again.
+        if parsed or len(cached) != len(self.requirements):
+            self.dirty = True
+
+    def save(self):
+        if not self.cache_file or not self.dirty:
+            return
+        dirname = os.path.dirname(self.cache_file)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'requirements': self.requirements,
+                       'declared': self.declared}, f)
+        os.rename(tmp, self.cache_file)
+        self.dirty = False
+
+    def _load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+            if 'requirements' not in data:
+                return {}
+            return data
+        except (IOError, ValueError):
+            logger.warning("Ignoring unreadable dependency cache {0}".format(self.cache_file))
+            return {}
 
     def recompute_file(self, template):
-        old_attached = []
-        if not template.endswith('.html'):
+        if not template.endswith(('.html', '.less')):
             return
-        if template in self.dependency_graph:
-            old_attached = list(self.dependency_graph.successors(template))
-            self.dependency_graph.remove_node(template)
-        for requirement in self._get_requirements(template):
+        self.closures = {}
+        self.dirty = True
+        if template in self.requirements:
+            self._unlink(template, self.requirements.pop(template)[2])
+        requirements = self._get_requirements(template)
+        path = os.path.join(self.source, template)
+        if os.path.exists(path):
+            st = os.stat(path)
+            self.requirements[template] = [st.st_size, st.st_mtime, requirements]
+        self._link(template, requirements)
+
+    def remove_file(self, name):
+        self.closures = {}
+        self.dirty = True
+        if name in self.requirements:
+            self._unlink(name, self.requirements.pop(name)[2])
+        self._unlink(name, self.declared.pop(name, {}))
+
+    def _link(self, template, requirements):
+        for requirement in requirements:
             if requirement:
-                self.dependency_graph.add_edge(requirement, template)
-        for old_name in old_attached:
-            self.dependency_graph.add_edge(template, old_name)
+                self.dependents[requirement].add(template)
+
+    def _unlink(self, template, requirements):
+        for requirement in requirements:
+            self.dependents.get(requirement, set()).discard(template)
 
     def _get_requirements(self, template_name):
+        from jinja2 import meta
+        if template_name.endswith('.less'):
+            imports = [self._name(path) for path in find_imports(os.path.join(self.source, template_name))]
+            return [name for name in imports if not os.path.isabs(name)]
         try:
             return list(meta.find_referenced_templates(self.env.parse(self.loader.get_source(self.env, template_name))))
         except Exception as e:
@@ -0,0 +1,23 @@
+"""Stand-in compiler worker that hands every file back unchanged.
+
+Run as ``python -m jinjastatic.echoworker``; it speaks the protocol
+described in ``workers.PersistentCompiler``.
+"""
+import sys
+import json
+
+
+def main(stdin=sys.stdin, stdout=sys.stdout):
+    while True:
+        line = stdin.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        data = stdin.read(request['length'])
+        stdout.write(json.dumps({'status': 0, 'length': len(data)}) + '\n')
+        stdout.write(data)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
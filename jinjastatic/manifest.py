@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import logging
+
+__all__ = [
+    'Manifest',
+    'config_signature',
+]
+
+logger = logging.getLogger('jinjastatic')
+
+
+class Manifest(object):
+    """Content hashes of sources and the signature each output was built from.
+
+    Hashes are cached against size and mtime, so a touched but unchanged
+    file costs a rehash and never a rebuild.
+    """
+    def __init__(self, path, signature=''):
+        self.path = path
+        self.signature = signature
+        self.hashes = {}
+        self.outputs = {}
+        self.sources = {}
+        self.records = {}
+        self.fresh = {}
+        self.snapshots = []
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            logger.warning("Ignoring unreadable build manifest {0}".format(self.path))
+            return
+        self.hashes = data.get('hashes', {})
+        self.outputs = data.get('outputs', {})
+        self.sources = data.get('sources', {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'hashes': self.hashes, 'outputs': self.outputs, 'sources': self.sources}, f)
+        os.rename(tmp, self.path)
+        self.dirty = False
+
+    def stat(self, filename):
+        """Stat `filename` from the build's snapshots if they cover it; None if it is missing."""
+        for snapshot in self.snapshots:
+            known, st = snapshot.lookup(filename)
+            if known:
+                return st
+        try:
+            return os.stat(filename)
+        except OSError:
+            return None
+
+    def digest(self, filename):
+        filename = os.path.abspath(filename)
+        st = self.stat(filename)
+        if st is None:
+            raise OSError(2, 'No such file or directory', filename)
+        cached = self.hashes.get(filename)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+        self.hashes[filename] = self.fresh[filename] = [st.st_size, st.st_mtime, digest]
+        self.dirty = True
+        return digest
+
+    def is_updated(self, source, dest, signed=False, deps=()):
+        if self.stat(dest) is None:
+            return True
+        return self.outputs.get(os.path.abspath(dest)) != self._entry(source, signed, deps)
+
+    def record(self, source, dest, signed=False, deps=()):
+        dest = os.path.abspath(dest)
+        for snapshot in self.snapshots:
+            snapshot.forget(dest)
+        self.dirty = True
+        self.outputs[dest] = self._entry(source, signed, deps)
+        self.sources[dest] = os.path.abspath(source)
+        self.records[dest] = (self.outputs[dest], self.sources[dest])
+
+    def drain(self):
+        """Hand over the outputs recorded and the files hashed since the last call."""
+        drained = (self.records, self.fresh)
+        self.records, self.fresh = {}, {}
+        return drained
+
+    def merge(self, drained):
+        records, hashes = drained
+        for dest, (entry, source) in records.items():
+            self.outputs[dest] = entry
+            self.sources[dest] = source
+        self.hashes.update(hashes)
+        self.dirty = True
+
+    def outputs_of(self, source):
+        source = os.path.abspath(source)
+        return [dest for dest, origin in self.sources.items() if origin == source]
+
+    def orphans(self):
+        """Return the recorded outputs whose source no longer exists."""
+        return [dest for dest, source in self.sources.items() if self.stat(source) is None]
+
+    def invalidate(self, dest):
+        """Make the next build treat `dest` as out of date."""
+        self.outputs.pop(os.path.abspath(dest), None)
+        self.dirty = True
+
+    def remove(self, dest):
+        dest = os.path.abspath(dest)
+        self.outputs.pop(dest, None)
+        self.sources.pop(dest, None)
+        for snapshot in self.snapshots:
+            snapshot.forget(dest)
+        self.dirty = True
+
+    def _entry(self, source, signed, deps=()):
+        entry = self.digest(source)
+        for dep in deps:
+            entry += ':' + (self.digest(dep) if self.stat(dep) is not None else '-')
+        if signed:
+            entry += ':' + self.signature
+        return entry
+
+
+def config_signature(config, debug):
+    data = json.dumps([config, debug], sort_keys=True, default=repr)
+    return hashlib.md5(data).hexdigest()
@@ -0,0 +1,93 @@
+import heapq
+import logging
+import itertools
+import threading
+
+__all__ = [
+    'RenderQueue',
+]
+
+logger = logging.getLogger('jinjastatic')
+
+
+class RenderQueue(object):
+    """Renders stale pages one at a time on a background thread.
+
+    Pages that were edited or requested most recently go first, so a new
+    change jumps ahead of whatever is left of an earlier fan-out instead of
+    waiting behind it.
+    """
+    def __init__(self, render, on_idle=None):
+        self.render = render
+        self.on_idle = on_idle
+        self.stale = set()
+        self.priority = {}
+        self.heap = []
+        self.clock = itertools.count(1)
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def mark_stale(self, names, edited=()):
+        with self.condition:
+            for name in names:
+                self.stale.add(name)
+                self._push(name)
+            for name in edited:
+                self._touch(name)
+            self.condition.notify()
+
+    def touch(self, name):
+        with self.condition:
+            self._touch(name)
+
+    def discard(self, name):
+        with self.condition:
+            if name not in self.stale:
+                return False
+            self.stale.remove(name)
+            return True
+
+    def cancel(self):
+        """Drop every page still waiting to be rendered and return their names."""
+        with self.condition:
+            cancelled = sorted(self.stale)
+            self.stale.clear()
+            del self.heap[:]
+        return cancelled
+
+    def run(self):
+        while True:
+            with self.condition:
+                name = self._pop()
+            if name is None:
+                if self.on_idle:
+                    self.on_idle()
+                with self.condition:
+                    if not self.stale:
+                        self.condition.wait()
+                continue
+            try:
+                self.render(name)
+            except Exception:
+                logger.error("Error rendering {0}".format(name), exc_info=True)
+
+    def _touch(self, name):
+        self.priority[name] = next(self.clock)
+        if name in self.stale:
+            self._push(name)
+
+    def _push(self, name):
+        heapq.heappush(self.heap, (-self.priority.get(name, 0), next(self.order), name))
+
+    def _pop(self):
+        while self.heap:
+            priority, order, name = heapq.heappop(self.heap)
+            # Entries are never updated in place; skip the ones that were
+            # rendered already or superseded by a later touch.
+            if name in self.stale and -priority == self.priority.get(name, 0):
+                self.stale.remove(name)
+                return name
+        return None
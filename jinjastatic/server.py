@@ -0,0 +1,194 @@
+import os
+import Queue
+import logging
+import threading
+import mimetypes
+import traceback
+import BaseHTTPServer
+import SocketServer
+
+import staticlib
+from renderqueue import RenderQueue
+
+__all__ = [
+    'DevServer',
+    'serve',
+]
+
+logger = logging.getLogger('jinjastatic')
+
+EVENTS_PATH = '/__jinjastatic__/events'
+
+RELOAD_SCRIPT = ('<script>new EventSource("{0}").onmessage = '
+                 'function() {{ location.reload(); }};</script>').format(EVENTS_PATH)
+
+
+class DevServer(object):
+    """Serves the site from memory, rendering pages the first time they are requested.
+
+    It is also the watch callback: a change drops the stale pages from
+    memory, re-renders the ones that had been viewed in the background,
+    most recently requested first, and tells every open browser to reload.
+    """
+    def __init__(self, source, dependencies, render):
+        self.source = source
+        self.dependencies = dependencies
+        self.render = render
+        self.pages = {}
+        self.clients = []
+        self.lock = threading.RLock()
+        self.queue = RenderQueue(self._prerender)
+
+    def __call__(self, files, deleted=()):
+        with self.lock:
+            for fname in deleted:
+                self.dependencies.remove_file(fname)
+                self.queue.discard(fname)
+            for fname in files:
+                self.dependencies.recompute_file(fname)
+            stale = set(files) | set(deleted)
+            stale.update(self.dependencies.get_affected(list(files) + list(deleted)))
+            viewed = [fname for fname in stale if fname.lower().endswith('.html') and fname in self.pages
+                      and fname not in deleted]
+            for fname in stale:
+                self.pages.pop(fname, None)
+                for name in self._compiled_names(fname):
+                    self.pages.pop(name, None)
+            clients = list(self.clients)
+        self.queue.mark_stale(viewed, edited=[fname for fname in files if fname in viewed])
+        logger.info("Reloading {0} browser(s) after changes to {1}".format(
+                len(clients), ', '.join(sorted(set(files) | set(deleted)))))
+        for client in clients:
+            client.put('reload')
+
+    def get(self, name):
+        self.queue.touch(name)
+        self.queue.discard(name)
+        with self.lock:
+            if name not in self.pages:
+                data = self._build(name)
+                if data is None:
+                    return None
+                self.pages[name] = data
+            return self.pages[name]
+
+    def _prerender(self, name):
+        with self.lock:
+            if name not in self.pages:
+                self.pages[name] = self._build(name)
+
+    def subscribe(self):
+        client = Queue.Queue()
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.remove(client)
+
+    def _build(self, name):
+        fullsource = os.path.join(self.source, name)
+        if name.lower().endswith('.html') and os.path.isfile(fullsource):
+            logger.info("Rendering {0}".format(name))
+            data = self.render(name)
+            if data is None:
+                raise RuntimeError("Could not render {0}, see the log for details".format(name))
+            return data
+        if os.path.isfile(fullsource):
+            with open(fullsource, 'rb') as f:
+                return f.read()
+        for original in self._original_names(name):
+            if os.path.isfile(os.path.join(self.source, original)):
+                logger.info("Pre-compiling {0}".format(original))
+                return staticlib.precompile_data(os.path.join(self.source, original))
+        return None
+
+    def _compiled_names(self, name):
+        mime = staticlib.ext_mime.get(name.rsplit('.', 1)[-1])
+        if mime in staticlib.pre_compilers:
+            yield staticlib.rename_ext(name, staticlib.pre_compilers[mime][2])
+
+    def _original_names(self, name):
+        for ext, mime in staticlib.ext_mime.items():
+            compiler = staticlib.pre_compilers.get(mime)
+            if compiler and compiler[3] and name.endswith('.' + compiler[2]):
+                yield staticlib.rename_ext(name, ext)
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].split('#', 1)[0]
+        if path == EVENTS_PATH:
+            return self._send_events()
+        name = path.lstrip('/')
+        if not name or name.endswith('/'):
+            name += 'index.html'
+        name = os.path.normpath(name)
+        if name.startswith('..'):
+            return self.send_error(403)
+        try:
+            data = self.server.site.get(name)
+        except Exception:
+            logger.error("Error serving {0}".format(name), exc_info=True)
+            return self._send(500, 'text/plain', traceback.format_exc())
+        if data is None:
+            return self.send_error(404)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type == 'text/html':
+            data = _inject_reload(data)
+        self._send(200, content_type, data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        client = self.server.site.subscribe()
+        try:
+            while True:
+                try:
+                    event = client.get(timeout=15)
+                except Queue.Empty:
+                    # Keep-alive comment, also notices closed connections.
+                    self.wfile.write(': ping\n\n')
+                else:
+                    self.wfile.write('data: {0}\n\n'.format(event))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            self.server.site.unsubscribe(client)
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _inject_reload(data):
+    index = data.lower().rfind('</body>')
+    if index == -1:
+        return data + RELOAD_SCRIPT
+    return data[:index] + RELOAD_SCRIPT + data[index:]
+
+
+def serve(site, host='127.0.0.1', port=8000):
+    httpd = HTTPServer((host, port), RequestHandler)
+    httpd.site = site
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    logger.info("Serving on http://{0}:{1}/".format(host, port))
+    return httpd
@@ -0,0 +1,74 @@
+import os
+import stat
+import collections
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+__all__ = [
+    'Snapshot',
+]
+
+
+class Snapshot(object):
+    """The files under a directory and their stat results, read in one walk.
+
+    A build takes one snapshot of the source and one of the destination and
+    shares them between its phases, so each file is stat'ed once per build.
+    `lookup` answers for any path under the root, including files that do
+    not exist; paths written since the walk are passed to `forget`.
+    """
+    def __init__(self, root, exclude=()):
+        self.root = os.path.abspath(root)
+        self.exclude = set(exclude)
+        self.files = collections.OrderedDict()
+        self.forgotten = set()
+        if os.path.isdir(self.root):
+            self._scan(self.root, '')
+
+    def __iter__(self):
+        return iter(self.files.items())
+
+    def lookup(self, path):
+        """Return (known, stat) for `path`; stat is None for a missing file."""
+        path = os.path.abspath(path)
+        if not path.startswith(self.root + os.sep) or path in self.forgotten:
+            return False, None
+        return True, self.files.get(path[len(self.root) + 1:])
+
+    def forget(self, path):
+        self.forgotten.add(os.path.abspath(path))
+
+    def _scan(self, dirpath, reldir):
+        subdirs = []
+        for name, st in _entries(dirpath):
+            if not reldir and name in self.exclude:
+                continue
+            if st is None:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(name)
+            else:
+                self.files[os.path.join(reldir, name)] = st
+        for name in subdirs:
+            self._scan(os.path.join(dirpath, name), os.path.join(reldir, name))
+
+
+def _entries(dirpath):
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            try:
+                yield entry.name, entry.stat()
+            except OSError:
+                yield entry.name, None
+        return
+    for name in os.listdir(dirpath):
+        try:
+            yield name, os.stat(os.path.join(dirpath, name))
+        except OSError:
+            yield name, None
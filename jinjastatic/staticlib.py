@@ -1,31 +1,28 @@
 import os
 import sys
 import glob
-import time
 import pipes
 import shutil
-import random
 import tempfile
 import traceback
+import subprocess
+import json
 import hashlib
 import urlparse
 import logging
 import collections
+import atexit
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
-import envoy
 import jinjatagext
 
-from utils import is_updated
-import notify
-
-try:
-    notify.register("Jinja-Static")
-except Exception as e:
-    sys.stderr.write("Notifications not supported: {0}\n".format(traceback.format_exc()))
+from utils import is_updated, mark_updated, file_digest, get_cache_dir, with_dir, replace_file, link_or_copy
+from dependencies import find_all_imports
+from workers import PersistentCompiler
+from timings import timed
 
 logger = logging.getLogger('jinjastatic')
 
@@ -58,11 +55,21 @@ g = {
     ('text/javascript', False): {},
     ('text/css', True): {},
     ('text/javascript', True): {},
-    'temp_dir': tempfile.mkdtemp(prefix='jinjastatic'),
+    'temp_dir': None,
     'config': {},
     'compiled': {},
     'compsheets': {},
     'minified': {},
+    'markers': {},
+    'contributions': {},
+    'page': None,
+    'links': {},
+    'data_edges': {},
+    'compile_jobs': 1,
+    'precompiles': OrderedDict(),
+    'defer_precompiles': False,
+    'executor': None,
+    'pending': [],
 }
 
 def _handle_tag(type_, ctx, src, debug=False, head=False, **kwargs):
@@ -79,26 +86,91 @@ def _handle_tag(type_, ctx, src, debug=False, head=False, **kwargs):
         return u''
     key = (type_, head)
     compiled_key = (pre_compilers.get(type_, (None, type_))[1], head)
-    format = style_formats[compiled_key[0]]
     ctxname = ctx.name
-    min_dict = g['minified'].setdefault(ctxname, {})
+    # Tags in an included template register under its name, but the links
+    # and markers belong to the page being written.
+    page = g['page'] or ctxname
+    min_dict = g['minified'].setdefault(page, {})
 
-    if min_dict.get(compiled_key):
+    if min_dict.get((ctxname, compiled_key)):
         return ''
     elif ctxname in g.get(compiled_key, {}) and g['compiled']:
-        files = OrderedDict([(g['compiled'][orig], 1)
-                             for orig in g[compiled_key][ctxname]]).keys()
-        min_dict[compiled_key] = True
-        src = urlparse.urljoin(g['config'].get('static_root', ''), src)
-        return u'\n'.join(format.format(urlparse.urljoin(g['config'].get('static_root', ''), src),
-                                        'type="{0}"'.format(compiled_key[0]))
-                          for src in files)
+        min_dict[(ctxname, compiled_key)] = True
+        return bundle_links(ctxname, compiled_key)
     elif type_ in pre_compilers:
-        pre_compile(src, type_, head, ctxname)
-        return u''
+        src = pre_compile(src, type_, head, ctxname)
     else:
-        g[key].setdefault(ctxname, []).append(src.lstrip('/'))
-    return '**FIRSTPASS**'
+        src = src.lstrip('/')
+        g[key].setdefault(ctxname, []).append(src)
+    # Saved per page, so an incremental build can drop exactly what the
+    # pages it renders again registered, through includes too.
+    g['contributions'].setdefault(page, []).append((ctxname,) + compiled_key + (src,))
+    return _bundle_marker(page, ctxname, compiled_key)
+
+def start_page(page):
+    g['page'] = page
+
+def bundle_links(ctxname, compiled_key):
+    format = style_formats[compiled_key[0]]
+    files = OrderedDict([(g['compiled'][orig], 1)
+                         for orig in g[compiled_key][ctxname]]).keys()
+    return u'\n'.join(format.format(urlparse.urljoin(g['config'].get('static_root', ''), src),
+                                    'type="{0}"'.format(compiled_key[0]))
+                      for src in files)
+
+# Bundle names are only known once every page has been rendered, so the
+# first tag of each bundle leaves a marker that patch_markers fills in.
+MARKER_PREFIX = u'<!--jinjastatic-bundle:'
+MARKER = MARKER_PREFIX + u'{0}:{1}:{2}-->'
+
+def _bundle_marker(page, ctxname, compiled_key):
+    markers = g['markers'].setdefault(page, [])
+    entry = (ctxname,) + compiled_key
+    if entry in markers:
+        return u''
+    markers.append(entry)
+    return MARKER.format(*entry)
+
+def has_markers(page):
+    return not g['debug'] and not g['compiled'] and bool(g['markers'].get(page))
+
+def patch_markers(page, data):
+    """Replace the bundle markers left in a rendered page.
+
+    Returns None when a marker is missing, for instance because a filter
+    rewrote it, or one is left over, and the page has to be rendered again.
+    """
+    for entry in g['markers'].get(page, ()):
+        marker = MARKER.format(*entry).encode('utf8')
+        if marker not in data:
+            return None
+        data = data.replace(marker, bundle_links(entry[0], entry[1:]).encode('utf8'), 1)
+    if MARKER_PREFIX.encode('utf8') in data:
+        return None
+    return data
+
+class MissingMarker(Exception):
+    pass
+
+def patch_marker_lines(page, lines):
+    """Like patch_markers, for a page read a line at a time.
+
+    Raises MissingMarker after the last line if a marker was never seen or
+    one is left over, so whatever was written from the lines has to be
+    thrown away.
+    """
+    pending = [(MARKER.format(*entry).encode('utf8'), entry) for entry in g['markers'].get(page, ())]
+    prefix = MARKER_PREFIX.encode('utf8')
+    stray = False
+    for line in lines:
+        for marker, entry in list(pending):
+            if marker in line:
+                line = line.replace(marker, bundle_links(entry[0], entry[1:]).encode('utf8'), 1)
+                pending.remove((marker, entry))
+        stray = stray or prefix in line
+        yield line
+    if pending or stray:
+        raise MissingMarker(page)
 
 
 style_formats = {
@@ -129,77 +201,216 @@ def coffee(ctx, src, **kwargs):
                        src, **kwargs)
 
 def clear_data():
-    try:
-        shutil.rmtree(g['temp_dir'])
-    except:
-        pass
+    if g['temp_dir']:
+        shutil.rmtree(g['temp_dir'], ignore_errors=True)
     g.update({
             ('text/css', False): {},
             ('text/javascript', False): {},
             ('text/css', True): {},
             ('text/javascript', True): {},
             'compiled': {},
-            'temp_dir': tempfile.mkdtemp(prefix='jinjastatic'),
+            'temp_dir': None,
             'minified': {},
+            'markers': {},
+            'contributions': {},
+            'links': {},
+            'data_edges': {},
+            'precompiles': OrderedDict(),
             })
 
-def set_config(debug, config, base_dir):
+def load_bundles(path, base_dir):
+    """Restore the bundle registrations saved by the previous production build.
+
+    Returns the pre-compilations it ran, so they can be checked again even
+    if no page using them is rendered this time.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        logger.warning("Ignoring unreadable bundle state {0}".format(path))
+        return {}
+    if 'contributions' not in data:
+        logger.warning("Ignoring bundle state from an older version {0}".format(path))
+        return {}
+    exists = lambda page: os.path.exists(os.path.join(base_dir, page))
+    g['contributions'] = dict((page, [tuple(entry) for entry in entries])
+                              for page, entries in data['contributions'].items() if exists(page))
+    g['markers'] = dict((page, [tuple(entry) for entry in entries])
+                        for page, entries in data['markers'].items() if exists(page))
+    g['links'] = data['links']
+    _rebuild_assets()
+    return dict((new_file, entry) for new_file, entry in data['precompiles'].items()
+                if os.path.exists(entry[0]))
+
+def save_bundles(path):
+    registered = set(filename for key in g if isinstance(key, tuple)
+                     for files in g[key].values() for filename in files)
+    data = {
+        'contributions': g['contributions'],
+        'markers': g['markers'],
+        'links': dict((page, page_links(page)) for page in g['markers']),
+        'precompiles': dict((new_file, entry) for new_file, entry in g['precompiles'].items()
+                            if os.path.relpath(new_file, g['base_dir']) in registered),
+        }
+    with with_dir(open, path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
+
+def forget_pages(pages):
+    """Drop the registrations of pages that are about to be rendered again.
+
+    Returns the kept pages whose bundles can no longer be filled in, which
+    have to be rendered again as well.
+    """
+    for key in ('contributions', 'markers', 'minified', 'data_edges'):
+        for page in pages:
+            g[key].pop(page, None)
+    _rebuild_assets()
+    stale = set(page for page, entries in g['markers'].items()
+                if any(entry[0] not in g[entry[1:]] for entry in entries))
+    if stale:
+        forget_pages(stale)
+    return stale
+
+def _rebuild_assets():
+    g.update((key, {}) for key in g if isinstance(key, tuple))
+    for page, entries in sorted(g['contributions'].items()):
+        for ctxname, mime, head, src in entries:
+            files = g[(mime, head)].setdefault(ctxname, [])
+            if src not in files:
+                files.append(src)
+
+def page_links(page):
+    return [bundle_links(entry[0], entry[1:]) for entry in g['markers'].get(page, ())]
+
+def links_changed(page):
+    return g['links'].get(page) != page_links(page)
+
+def add_dependency(template_name, path):
+    """Declare that rendering `template_name` reads `path`.
+
+    For plugins that load data files, so that editing the file rebuilds
+    the pages using it.
+    """
+    g['data_edges'].setdefault(template_name, []).append(path)
+
+def pop_edges():
+    edges, g['data_edges'] = g['data_edges'], {}
+    return edges
+
+def get_state():
+    return dict((key, g[key]) for key in ('debug', 'base_dir', 'config', 'compiled'))
+
+def set_state(state):
+    g.update(state)
+    g.update((key, {}) for key in _asset_keys())
+    g['minified'] = {}
+    g['precompiles'] = OrderedDict()
+    g['defer_precompiles'] = True
+    g['executor'] = None
+    _load_workers(g['config'])
+
+def _asset_keys():
+    return [key for key in g if isinstance(key, tuple)] + ['markers', 'contributions', 'data_edges']
+
+def pop_assets():
+    """Hand over everything registered since the last call, under every template name.
+
+    Pool workers start empty and send this back after each page, for the
+    parent to merge in page order.
+    """
+    assets = dict((key, g[key]) for key in _asset_keys() if g[key])
+    g.update((key, {}) for key in _asset_keys())
+    return assets
+
+def merge_assets(assets):
+    for key, filemap in assets.items():
+        for ctxname, files in filemap.items():
+            g[key].setdefault(ctxname, []).extend(files)
+
+def set_config(debug, config, base_dir, compile_jobs=1):
     g['debug'] = debug
     g['base_dir'] = base_dir
+    g['compile_jobs'] = compile_jobs
     mapper = config.get('map', {})
     config['map'] = {}
     for k, v in mapper.items():
         for f in v:
             config['map'][f] = k
     g['config'] = config
+    # Watch mode and the daemon configure every build; keep the worker
+    # processes running unless their commands changed.
+    if config.get('workers', {}) != g.get('worker_config'):
+        stop_workers()
+        _load_workers(config)
+
+def _load_workers(config):
+    g['worker_config'] = dict(config.get('workers', {}))
+    g['workers'] = dict((mime, PersistentCompiler(cmd))
+                        for mime, cmd in config.get('workers', {}).items())
+
+@atexit.register
+def stop_workers():
+    for worker in g.get('workers', {}).values():
+        worker.stop()
 
 def compile(base_dir, output_dir, dest_dir):
     config = g['config']
-    _remove_old_files(output_dir)
 
     rel_output = '/' + output_dir[len(dest_dir):].lstrip('/')
 
     static_dirs = set()
+    produced = set()
+    bundles = []
+    cache_dir = os.path.join(get_cache_dir(dest_dir), 'minified')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
 
     for key in g:
         if not isinstance(key, tuple):
             continue
-        unique_key = _gen_key()
         filemap = g[key]
         ext = extensions[key[0]]
+        compiler_fmt = _get_compiler(key[0], compilers[key[0]])
         files = OrderedDict((filename, 1) for template in filemap for filename in filemap[template]).keys()
         file_comp = collections.defaultdict(list)
         for filename in files:
-            aggregate = _decorate_key(config['map'].get(filename, 'maincompiled.' + ext), unique_key)
-            file_comp[aggregate].append(filename)
-        for target, filelist in file_comp.items():
-            abstarget = os.path.join(output_dir, target)
+            file_comp[config['map'].get(filename, 'maincompiled.' + ext)].append(filename)
+        for aggregate, filelist in file_comp.items():
             absfilelist = [os.path.join(base_dir, filename) for filename in filelist]
-            logger.info('Compiling {0}'.format(abstarget))
-            combined_file_obj = None
-            if len(absfilelist) == 1:
-                combined_file = absfilelist[0]
-            else:
-                combined_file_obj = _combine_files(absfilelist, ext)
-                combined_file = combined_file_obj.name
-
-            compiler_fmt = compilers[key[0]]
-            if '%(input)s' in compiler_fmt:
-                data = None
-                cmd = compiler_fmt % {'input': combined_file}
+            digest = _bundle_digest(absfilelist, compiler_fmt)
+            target = _decorate_key(aggregate, _gen_key(digest))
+            abstarget = os.path.join(output_dir, target)
+            cached = os.path.join(cache_dir, digest + '.' + ext)
+            produced.add(abstarget)
+            if os.path.exists(abstarget):
+                logger.debug('Unchanged {0}'.format(abstarget))
+            elif os.path.exists(cached):
+                logger.info('Compiling {0} (cached)'.format(abstarget))
+                _copy_atomic(cached, abstarget)
             else:
-                data = read_file_data([combined_file])
-                cmd = compiler_fmt
-            output = run_command(cmd, data=data)
-
-            with open(abstarget, 'wb+') as f:
-                f.write(output.std_out)
+                bundles.append((absfilelist, abstarget, cached, compiler_fmt, ext))
             target = os.path.join(rel_output, target)
             g['compiled'].update(dict((filename, target) for filename in filelist))
 
             if key[0] == 'text/css':
                 static_dirs.update(os.path.dirname(filename) for filename in absfilelist)
 
+    failed = []
+    for bundle, error in zip(bundles, _map_jobs(_compile_bundle, bundles)):
+        if error:
+            failed.append(bundle[1])
+            logger.error('Failed compiling {0}: {1}'.format(bundle[1], error))
+    if failed:
+        _notify_failure(', '.join(failed))
+        sys.stderr.write("Error while compiling: {0}\n".format(', '.join(failed)))
+        sys.exit(1)
+
+    _remove_old_files(output_dir, produced)
+
     for d in static_dirs:
         for dirpath, dirnames, filenames in os.walk(d, followlinks=True):
             reldir = dirpath[len(d):].lstrip('/')
@@ -208,10 +419,8 @@ def compile(base_dir, output_dir, dest_dir):
                 target_path = os.path.join(target_dir, filepath)
                 filepath = os.path.join(dirpath, filepath)
                 if is_updated(filepath, target_path):
-                    new_dir = os.path.dirname(target_path)
-                    if not os.path.exists(new_dir):
-                        os.makedirs(new_dir)
-                    shutil.copyfile(filepath, target_path)
+                    link_or_copy(filepath, target_path)
+                    mark_updated(filepath, target_path)
 
 g = {
     'debug': False,
@@ -219,36 +428,175 @@ g = {
     ('text/javascript', False): {},
     ('text/css', True): {},
     ('text/javascript', True): {},
-    'temp_dir': tempfile.mkdtemp(prefix='jinjastatic'),
+    'temp_dir': None,
     'config': {},
     'compiled': {},
     'compsheets': {},
     'minified': {},
+    'markers': {},
+    'contributions': {},
+    'page': None,
+    'links': {},
+    'data_edges': {},
+    'compile_jobs': 1,
+    'precompiles': OrderedDict(),
+    'defer_precompiles': False,
+    'executor': None,
+    'pending': [],
 }
 
+def _map_jobs(func, jobs):
+    if g['compile_jobs'] <= 1 or len(jobs) <= 1:
+        return [func(*job) for job in jobs]
+    import multiprocessing.pool
+    pool = multiprocessing.pool.ThreadPool(min(g['compile_jobs'], len(jobs)))
+    try:
+        return pool.map(lambda job: func(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def _compile_bundle(absfilelist, abstarget, cached, compiler_fmt, ext):
+    logger.info('Compiling {0}'.format(abstarget))
+    try:
+        with timed('subprocess', 'minify ' + abstarget):
+            _minify(absfilelist, abstarget, compiler_fmt, ext)
+    except CommandError as e:
+        return str(e)
+    _copy_atomic(abstarget, cached)
+
+def _minify(absfilelist, abstarget, compiler_fmt, ext):
+    # Write beside the target first: an existing bundle name is taken as
+    # proof that the bundle is complete.
+    tmp_target = abstarget + '.tmp'
+    if isinstance(compiler_fmt, PersistentCompiler):
+        data = ''.join(_iter_bundle(absfilelist, ext))
+        with open(tmp_target, 'wb+') as f:
+            f.write(check_worker(compiler_fmt, abstarget, data))
+    elif '%(input)s' in compiler_fmt and len(absfilelist) == 1:
+        stream_command(compiler_fmt % {'input': absfilelist[0]}, tmp_target)
+    else:
+        # A command that takes a file name reads a bundle of several from
+        # its stdin instead of a combined copy.
+        if '%(input)s' in compiler_fmt:
+            compiler_fmt = compiler_fmt % {'input': '/dev/stdin'}
+        stream_command(compiler_fmt, tmp_target, _iter_bundle(absfilelist, ext))
+    os.rename(tmp_target, abstarget)
+
+def _iter_bundle(filelist, ext):
+    separate = len(filelist) > 1 and ext.lower() == 'js'
+    for filename in filelist:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                yield chunk
+        if separate:
+            yield ';'
+
+def stream_command(cmd, output_file, chunks=()):
+    with open(output_file, 'wb') as out:
+        with tempfile.TemporaryFile() as err:
+            try:
+                process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                           stdout=out, stderr=err)
+            except OSError:
+                raise CommandError(cmd, traceback.format_exc())
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            except IOError:
+                # The command stopped reading; its exit status says why.
+                pass
+            finally:
+                process.stdin.close()
+            if process.wait():
+                err.seek(0)
+                raise CommandError(cmd, err.read())
+
+def _copy_atomic(source, dest):
+    shutil.copyfile(source, dest + '.tmp')
+    os.rename(dest + '.tmp', dest)
+
 def pre_compile(src, type_, head, ctxname):
-    compiler, type_, ext = pre_compilers[type_][:3]
+    mime = type_
+    type_, ext = pre_compilers[type_][1:3]
     key = (type_, head)
     script_list = g[key].setdefault(ctxname, [])
     old_file = os.path.join(g['base_dir'], src.lstrip('/'))
     new_name = os.path.join(os.path.dirname(src).strip('/'), 'compiled-' + hashlib.md5(src).hexdigest()) + "." + ext
 
     if new_name in script_list:
-        return
+        return new_name
 
     script_list.append(new_name)
 
-    new_name = os.path.join(g['base_dir'], new_name.lstrip('/'))
+    queue_precompile(old_file, os.path.join(g['base_dir'], new_name.lstrip('/')), mime)
+    return new_name
 
-    if not is_updated(old_file, new_name):
+def queue_precompile(old_file, new_file, mime):
+    if new_file in g['precompiles']:
         return
+    g['precompiles'][new_file] = (old_file, mime)
+    if g['defer_precompiles'] or not is_updated(old_file, new_file, deps=find_all_imports(old_file)):
+        return
+    compiler = _get_compiler(mime, pre_compilers[mime][0])
+    if g['executor'] is None:
+        _run_precompile(old_file, new_file, compiler)
+    else:
+        g['pending'].append((new_file, g['executor'].apply_async(
+                    _precompile_job, (old_file, new_file, compiler))))
 
-    _run_precompile(old_file, new_name, compiler)
+def pop_precompiles():
+    precompiles, g['precompiles'] = g['precompiles'], OrderedDict()
+    return precompiles
 
+def start_precompiles():
+    import multiprocessing.pool
+    g['executor'] = multiprocessing.pool.ThreadPool(max(1, g['compile_jobs']))
+    g['pending'] = []
+
+def finish_precompiles():
+    executor, g['executor'] = g['executor'], None
+    if executor is None:
+        return
+    failed = []
+    for new_file, result in g['pending']:
+        error = result.get()
+        if error:
+            failed.append(new_file)
+            logger.error('Failed pre-compiling {0}: {1}'.format(new_file, error))
+    g['pending'] = []
+    executor.close()
+    executor.join()
+    if failed:
+        _notify_failure(', '.join(failed))
+        sys.stderr.write("Error while pre-compiling: {0}\n".format(', '.join(failed)))
+        sys.exit(1)
+
+def _precompile_job(old_file, new_file, compiler):
+    try:
+        with timed('subprocess', 'pre-compile ' + old_file):
+            _precompile(old_file, new_file, compiler)
+    except CommandError as e:
+        return str(e)
 
 def _run_precompile(old_file, new_file, compiler):
+    try:
+        with timed('subprocess', 'pre-compile ' + old_file):
+            _precompile(old_file, new_file, compiler)
+    except CommandError as e:
+        _notify_failure(e.cmd)
+        sys.stderr.write("Error while running command: {0}\n".format(e.cmd))
+        sys.exit(1)
+
+def _precompile(old_file, new_file, compiler):
     logger.info('Pre-compiling {0} -> {1}'.format(old_file, new_file))
 
+    if isinstance(compiler, PersistentCompiler):
+        std_out = check_worker(compiler, old_file, read_file_data([old_file]))
+        replace_file(new_file, std_out)
+        mark_updated(old_file, new_file, deps=find_all_imports(old_file))
+        return
+
     params = {'input': pipes.quote(old_file)}
     use_stdout = True
 
@@ -256,13 +604,21 @@ def _run_precompile(old_file, new_file, compiler):
         use_stdout = False
         params['output'] = pipes.quote(new_file)
 
-    output = run_command(compiler % params)
+    output = check_command(compiler % params)
 
-    if not use_stdout:
-        return
-    with open(new_file, 'wb+') as f:
-        f.write(output.std_out)
-    return
+    if use_stdout:
+        replace_file(new_file, output.std_out)
+    mark_updated(old_file, new_file, deps=find_all_imports(old_file))
+
+def precompile_data(source):
+    mime = ext_mime.get(source.rsplit('.', 1)[-1])
+    if mime not in pre_compilers:
+        return None
+    compiler = _get_compiler(mime, pre_compilers[mime][0])
+    new_file = os.path.join(_get_temp_dir(), hashlib.md5(source).hexdigest() + '.' + pre_compilers[mime][2])
+    _precompile(source, new_file, compiler)
+    with open(new_file, 'rb') as f:
+        return f.read()
 
 def handle_precompile_file(source, dest, incremental=False):
     if '.' not in os.path.basename(source):
@@ -271,11 +627,12 @@ def handle_precompile_file(source, dest, incremental=False):
     if not (ext in ext_mime and ext_mime[ext] in pre_compilers):
         return False
     compiler, type_, new_ext, incremental = pre_compilers[ext_mime[ext]][:4]
+    compiler = _get_compiler(ext_mime[ext], compiler)
     if not incremental:
         return
     dest = rename_ext(dest, new_ext)
-    if incremental and not is_updated(source, dest):
-        return False
+    if incremental and not is_updated(source, dest, deps=find_all_imports(source)):
+        return True
     _run_precompile(source, dest, compiler)
     return True
 
@@ -286,26 +643,23 @@ def read_file_data(filelist):
             result.append(f.read())
     return ''.join(result)
 
-def _remove_old_files(output_dir):
+def _remove_old_files(output_dir, keep=()):
     for fname in glob.glob(os.path.join(output_dir, '*_min*')):
-        os.unlink(fname)
-
-def _combine_files(filelist, ext):
-    tmp = tempfile.NamedTemporaryFile(suffix='.' + ext)
-    for filename in filelist:
-        with open(filename, 'rb') as f:
-            shutil.copyfileobj(f, tmp)
-        if ext.lower() == 'js':
-            tmp.write(';')
-    tmp.flush()
-    return tmp
+        if fname not in keep:
+            os.unlink(fname)
 
 def _decorate_key(filename, key):
     first, second = filename.rsplit('.', 1)
     return first + '-' + key + '.' + second
 
-def _gen_key():
-    return hashlib.md5(str(time.time() + random.random())).hexdigest()[:10] + '_min'
+def _bundle_digest(filelist, compiler_fmt):
+    md5 = hashlib.md5(getattr(compiler_fmt, 'cmd', compiler_fmt))
+    for filename in filelist:
+        md5.update(file_digest(filename))
+    return md5.hexdigest()
+
+def _gen_key(digest):
+    return digest[:10] + '_min'
 
 
 def _force_str(obj):
@@ -319,7 +673,17 @@ def rename_ext(filename, new_ext):
     else:
         return filename.rsplit('.', 1)[0] + '.' + new_ext
 
-def run_command(cmd, **kwargs):
+class CommandError(Exception):
+    def __init__(self, cmd, std_err):
+        Exception.__init__(self, cmd, std_err)
+        self.cmd = cmd
+        self.std_err = std_err
+
+    def __str__(self):
+        return "{0}\n{1}".format(self.cmd, self.std_err)
+
+def check_command(cmd, **kwargs):
+    import envoy
     try:
         output = envoy.run(cmd, **kwargs)
         std_err = output.std_err
@@ -329,8 +693,33 @@ def run_command(cmd, **kwargs):
     else:
         status_code = output.status_code
     if status_code:
-        notify.send("Failure in Jinja-Static command", cmd,
-                    icon='gtk-dialog-critical', urgency='CRITICAL')
-        sys.stderr.write("Error while running command: {0}\n".format(cmd))
-        sys.exit(1)
+        raise CommandError(cmd, std_err)
     return output
+
+def check_worker(worker, path, data):
+    status, output = worker.compile(path, data)
+    if status:
+        raise CommandError(worker.cmd, output)
+    return output
+
+def _get_compiler(mime, default):
+    return g.get('workers', {}).get(mime, default)
+
+def _get_temp_dir():
+    if not g['temp_dir']:
+        g['temp_dir'] = tempfile.mkdtemp(prefix='jinjastatic')
+    return g['temp_dir']
+
+_notify = [None]
+
+def _notify_failure(message):
+    # Registering may load pynotify or Growl, so it waits for the first failure.
+    if _notify[0] is None:
+        import notify
+        try:
+            notify.register("Jinja-Static")
+        except Exception as e:
+            sys.stderr.write("Notifications not supported: {0}\n".format(traceback.format_exc()))
+        _notify[0] = notify
+    _notify[0].send("Failure in Jinja-Static command", message,
+                icon='gtk-dialog-critical', urgency='CRITICAL')
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+import collections
+
+__all__ = [
+    'profiler',
+    'timed',
+]
+
+logger = logging.getLogger('jinjastatic')
+
+
+class Profiler(object):
+    """Wall and CPU time spent in build phases, templates and compilers.
+
+    Disabled unless `--profile` is given, in which case every `timed` block
+    is recorded as one event. Pool workers send their events back to the
+    parent with `drain` and `merge`.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.origin = time.time()
+
+    def enable(self):
+        self.enabled = True
+        self.events = []
+        self.origin = time.time()
+
+    @contextlib.contextmanager
+    def timed(self, category, name):
+        if not self.enabled:
+            yield
+            return
+        start, cpu = time.time(), _cpu_time(category)
+        try:
+            yield
+        finally:
+            self.events.append({
+                    'cat': category,
+                    'name': name,
+                    'start': start,
+                    'wall': time.time() - start,
+                    'cpu': _cpu_time(category) - cpu,
+                    'pid': os.getpid(),
+                    'tid': threading.current_thread().ident,
+                    })
+
+    def drain(self):
+        events, self.events = self.events, []
+        return events
+
+    def merge(self, events):
+        self.events.extend(events)
+
+    def totals(self):
+        totals = collections.OrderedDict()
+        for event in self.events:
+            key = (event['cat'], event['name'])
+            wall, cpu, count = totals.get(key, (0.0, 0.0, 0))
+            totals[key] = (wall + event['wall'], cpu + event['cpu'], count + 1)
+        return totals
+
+    def report(self, top=10):
+        totals = self.totals()
+        categories = []
+        for category, name in totals:
+            if category not in categories:
+                categories.append(category)
+        for category in categories:
+            items = sorted(((value, name) for (cat, name), value in totals.items() if cat == category),
+                           reverse=True)
+            logger.info("{0}: {1} item(s), {2:.3f}s wall".format(
+                    category, len(items), sum(value[0] for value, name in items)))
+            for (wall, cpu, count), name in items[:top]:
+                logger.info("  {0:9.3f}s wall {1:9.3f}s cpu {2:5d}x  {3}".format(wall, cpu, count, name))
+
+    def write_trace(self, filename):
+        """Write the events in the Chrome trace format (chrome://tracing, Perfetto)."""
+        events = [{
+                'name': event['name'],
+                'cat': event['cat'],
+                'ph': 'X',
+                'ts': int((event['start'] - self.origin) * 1e6),
+                'dur': int(event['wall'] * 1e6),
+                'pid': event['pid'],
+                'tid': event['tid'],
+                'args': {'cpu': event['cpu']},
+                } for event in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _cpu_time(category):
+    times = os.times()
+    if category == 'subprocess':
+        # Only counts children that have been waited for, and every
+        # concurrent compiler, so it is a rough figure under --compile-jobs.
+        return times[2] + times[3]
+    return times[0] + times[1]
+
+
+profiler = Profiler()
+
+timed = profiler.timed
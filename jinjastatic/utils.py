@@ -1,9 +1,163 @@
 import os
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+from manifest import Manifest, config_signature
 
 __all__ = [
     'is_updated',
+    'mark_updated',
+    'file_digest',
+    'load_manifest',
+    'get_cache_dir',
+    'with_dir',
+    'replace_file',
+    'replace_file_chunks',
+    'replace_file_with',
+    'link_or_copy',
 ]
 
-def is_updated(old_file, new_file):
-    return not os.path.exists(new_file) or \
-        os.stat(old_file).st_mtime > os.stat(new_file).st_mtime
+CACHE_DIR = '.jinjastatic-cache'
+
+manifest = [None]
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+def is_updated(old_file, new_file, signed=False, deps=()):
+    if manifest[0] is not None:
+        return manifest[0].is_updated(old_file, new_file, signed, deps)
+    if not os.path.exists(new_file):
+        return True
+    mtime = os.stat(new_file).st_mtime
+    return any(os.path.exists(f) and os.stat(f).st_mtime > mtime
+               for f in [old_file] + list(deps))
+
+def mark_updated(old_file, new_file, signed=False, deps=()):
+    if manifest[0] is not None:
+        manifest[0].record(old_file, new_file, signed, deps)
+
+def file_digest(filename):
+    if manifest[0] is not None:
+        return manifest[0].digest(filename)
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def load_manifest(dest, config, debug):
+    path = os.path.join(get_cache_dir(dest), 'manifest.json')
+    signature = config_signature(config, debug)
+    # A long-running process keeps the manifest it already has in memory.
+    if manifest[0] is None or (manifest[0].path, manifest[0].signature) != (path, signature):
+        manifest[0] = Manifest(path, signature)
+    return manifest[0]
+
+def get_cache_dir(dest):
+    return os.path.join(dest, CACHE_DIR)
+
+def with_dir(callback, filename, *args, **kwargs):
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    return callback(filename, *args, **kwargs)
+
+def replace_file(filename, data):
+    """Atomically write `data` to `filename` unless it already holds exactly that.
+
+    Leaving identical outputs alone keeps their mtime, so rsync, CDN
+    uploads and file watchers downstream have nothing to do. Returns
+    whether the file was written.
+    """
+    if _same_contents(filename, len(data), lambda f: f.read() == data):
+        return False
+    with _replacing(filename) as tmp:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        # mkstemp creates the file private to us.
+        os.chmod(tmp, 0666 & ~_umask)
+    return True
+
+def replace_file_chunks(filename, chunks):
+    """Like `replace_file`, for data produced as an iterable of byte strings.
+
+    The chunks go to disk as they come, so the data is never all in memory;
+    the comparison with the old file happens once they are written.
+    """
+    with _replacing(filename) as tmp:
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(tmp, 0666 & ~_umask)
+        written = replace_file_with(filename, tmp)
+    return written
+
+def replace_file_with(filename, staged):
+    """Move `staged` over `filename`, or remove it if both hold the same data."""
+    if _same_contents(filename, os.path.getsize(staged), lambda f: _same_file_data(staged, f)):
+        os.unlink(staged)
+        return False
+    os.rename(staged, filename)
+    return True
+
+def link_or_copy(source, dest):
+    """Make `dest` a copy of `source`, as a hard link when the filesystem allows.
+
+    Returns whether `dest` changed.
+    """
+    st = os.stat(source)
+    try:
+        dest_st = os.stat(dest)
+    except OSError:
+        dest_st = None
+    if dest_st is not None and (dest_st.st_ino, dest_st.st_dev) == (st.st_ino, st.st_dev):
+        return False
+    if _same_contents(dest, st.st_size, lambda f: _same_file_data(source, f)):
+        return False
+    with _replacing(dest) as tmp:
+        os.unlink(tmp)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+    return True
+
+def _same_contents(filename, size, compare):
+    try:
+        if os.stat(filename).st_size != size:
+            return False
+        with open(filename, 'rb') as f:
+            return compare(f)
+    except (IOError, OSError):
+        return False
+
+def _same_file_data(source, other):
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            if other.read(len(chunk)) != chunk:
+                return False
+    return True
+
+@contextlib.contextmanager
+def _replacing(filename):
+    """Hand out a temporary name beside `filename`, renamed over it on success.
+
+    A caller that has already moved or removed the temporary file leaves
+    `filename` to it.
+    """
+    dirname = os.path.dirname(filename) or '.'
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filename))
+    os.close(fd)
+    try:
+        yield tmp
+        if os.path.lexists(tmp):
+            os.rename(tmp, filename)
+    except:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
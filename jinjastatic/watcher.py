@@ -1,12 +1,13 @@
 import sys
 import os
 import time
+import Queue
 import threading
 import logging
 import fnmatch
 
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileDeletedEvent
+from watchdog.events import FileSystemEventHandler, FileDeletedEvent, FileMovedEvent
 
 __all__ = [
     'setup_watch',
@@ -16,79 +17,98 @@ logger = logging.getLogger('jinjastatic')
 
 
 class EventHandler(FileSystemEventHandler):
-    def __init__(self, base_path, callback, excludes=[]):
+    def __init__(self, base_path, scheduler, excludes=[]):
         self.base_path = os.path.abspath(base_path)
-        self.modified_files = set()
-        self.promise = None
-        self.callback = callback
+        self.scheduler = scheduler
         self.excludes = excludes
 
     def on_any_event(self, event):
         if event.is_directory:
             return
-        path = event.src_path
-        path = path[len(self.base_path):].lstrip('/')
+        logger.debug("Caught event: {0}".format(event))
+        if isinstance(event, FileMovedEvent):
+            self.add(event.src_path, False)
+            self.add(event.dest_path, True)
+        else:
+            self.add(event.src_path, not isinstance(event, FileDeletedEvent))
+
+    def add(self, path, exists):
+        path = os.path.abspath(path)[len(self.base_path):].lstrip('/')
         for exclude in self.excludes:
             if fnmatch.fnmatch(path, exclude):
                 return
+        self.scheduler.add(path, exists)
 
-        logger.debug("Caught event: {0}".format(event))
-
-        if isinstance(event, FileDeletedEvent):
-            if path in self.modified_files:
-                self.modified_files.remove(path)
-            return
-
-        self.modified_files.add(path)
-        if not self.promise or self.promise.cancel():
-            self.promise = DelayedPromise(self.run_combined, 0.1)
 
-    def run_combined(self):
-        f = self.modified_files
-        self.modified_files = set()
-        logger.debug("Changed files: {0}".format(','.join(f)))
-        self.callback(list(f))
+class RebuildScheduler(threading.Thread):
+    """Runs the watch callback on one thread, one rebuild at a time.
 
-
-def setup_watch(src_dir, callback, excludes=[]):
-    observer = Observer()
-    observer.schedule(EventHandler(src_dir, callback, excludes), path=src_dir, recursive=True)
-    observer.start()
-    logger.info("Set up watching on {0} recursively. (CTRL-C to stop)".format(src_dir))
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
-
-
-class DelayedPromise(threading.Thread):
-    def __init__(self, callback, delay_time=0.1):
+    Events are coalesced per path, the last one winning, and a rebuild
+    starts once no event arrived for `delay` seconds. Every event that
+    arrives during the wait widens it, up to `max_delay`, so a checkout or
+    a save-storm ends up in one rebuild instead of a dozen; `max_wait`
+    bounds the total wait under a constant stream. Events arriving while a
+    rebuild runs are folded into the next one.
+    """
+    def __init__(self, callback, delay=0.1, max_delay=1.0, max_wait=5.0):
         threading.Thread.__init__(self)
-        self.cancelled = False
-        self.running = threading.Lock()
-        self.delay_time = delay_time
-        self.stopped = False
         self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.events = Queue.Queue()
         self.setDaemon(True)
-        self.start()
-
 
-    def cancel(self):
-        if self.running.acquire(False) or self.stopped:
-            self.cancelled = True
-            self.running.release()
-            return True
-        return False
+    def add(self, path, exists):
+        self.events.put((path, exists))
 
     def run(self):
-        time.sleep(self.delay_time)
-        self.running.acquire()
-        if self.cancelled:
+        while True:
+            changes = {}
+            path, exists = self.events.get()
+            changes[path] = exists
+            delay = self.delay
+            deadline = time.time() + self.max_wait
+            while True:
+                timeout = min(delay, deadline - time.time())
+                if timeout <= 0:
+                    break
+                try:
+                    path, exists = self.events.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                changes[path] = exists
+                delay = min(self.max_delay, delay * 1.5)
+            self.rebuild(changes)
+
+    def rebuild(self, changes):
+        changed = sorted(path for path, exists in changes.items() if exists)
+        deleted = sorted(path for path, exists in changes.items() if not exists)
+        logger.debug("Changed files: {0}; deleted files: {1}".format(','.join(changed), ','.join(deleted)))
+        if not changed and not deleted:
             return
-        self.stopped = True
         try:
-            self.callback()
-        finally:
-            self.running.release()
+            self.callback(changed, deleted)
+        except Exception:
+            logger.error("Error rebuilding after changes to {0}".format(
+                    ', '.join(changed + deleted)), exc_info=True)
+
+
+def setup_watch(src_dir, callback, excludes=[], on_interrupt=None):
+    scheduler = RebuildScheduler(callback)
+    scheduler.start()
+    observer = Observer()
+    observer.schedule(EventHandler(src_dir, scheduler, excludes), path=src_dir, recursive=True)
+    observer.start()
+    logger.info("Set up watching on {0} recursively. (CTRL-C to stop)".format(src_dir))
+    while True:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            # on_interrupt can claim a CTRL-C, for instance to cancel work
+            # in progress, and keep watching.
+            if on_interrupt is None or not on_interrupt():
+                break
+    observer.stop()
+    observer.join()
@@ -0,0 +1,69 @@
+import json
+import shlex
+import logging
+import threading
+import subprocess
+
+__all__ = [
+    'PersistentCompiler',
+]
+
+logger = logging.getLogger('jinjastatic')
+
+
+class PersistentCompiler(object):
+    """A long-lived compiler process fed one file at a time over stdin/stdout.
+
+    Each request is a JSON header line ``{"path": ..., "length": n}``
+    followed by ``n`` bytes of source. Each response is a JSON header line
+    ``{"status": s, "length": n}`` followed by ``n`` bytes of output, or of
+    error text when ``s`` is non-zero. See ``echoworker`` for a minimal
+    worker.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.process = None
+        self.lock = threading.Lock()
+
+    def compile(self, path, data):
+        with self.lock:
+            try:
+                return self._request(path, data)
+            except (IOError, OSError, ValueError) as e:
+                # The worker died or answered garbage; restart it once.
+                logger.debug("Restarting worker {0}: {1}".format(self.cmd, e))
+                self.stop()
+            try:
+                return self._request(path, data)
+            except (IOError, OSError, ValueError) as e:
+                self.stop()
+                return 1, "Worker {0} failed: {1}".format(self.cmd, e)
+
+    def start(self):
+        logger.debug("Starting worker {0}".format(self.cmd))
+        self.process = subprocess.Popen(shlex.split(self.cmd),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def stop(self):
+        process, self.process = self.process, None
+        if process is None or process.poll() is not None:
+            return
+        try:
+            process.stdin.close()
+            process.terminate()
+            process.wait()
+        except OSError:
+            pass
+
+    def _request(self, path, data):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        self.process.stdin.write(json.dumps({'path': path, 'length': len(data)}) + '\n')
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+        header = json.loads(self.process.stdout.readline())
+        output = self.process.stdout.read(header['length'])
+        if len(output) != header['length']:
+            raise IOError("Short read from worker")
+        return header['status'], output
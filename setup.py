@@ -8,7 +8,6 @@ import sys
 
 
 requirements = [
-    'networkx',
     'jinja2',
     'jinjatag',
     'watchdog==0.6.0',